@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the standalone Anvil & Loom server
+
+Starts a local mock of the OpenAI chat completions API, launches
+standalone_server.py against it and drives /api/batch-generate (plain and
+streaming), /api/openai, /api/chat and static GET / with the real tables in
+electron/tables as fixtures. Reports p50/p95/p99 latency, requests per
+second and the server's memory use - no API quota is spent.
+
+    python benchmark.py --concurrency 16 --duration 30
+    python benchmark.py --latency uniform:0.05,0.4 --rate-429 0.1 --json
+    python benchmark.py --server-url http://localhost:5000 --server-pid 1234
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import math
+import os
+import random
+import re
+import socket
+import shutil
+import subprocess
+import tempfile
+import sys
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+from standalone_server import table_type_from_name
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+SERVER_SCRIPT = SCRIPT_DIR / 'standalone_server.py'
+FIXTURE_DIR = SCRIPT_DIR.parent / 'electron' / 'tables'
+
+# Defaults
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DURATION = 20             # seconds, unless --requests is given
+DEFAULT_LATENCY = 'lognormal:0.3,0.5'
+DEFAULT_RATE_429 = 0.02
+DEFAULT_MALFORMED_RATE = 0.15
+DEFAULT_MIX = 'batch-generate=4,batch-generate-stream=1,openai=2,chat=2,static=1'
+MOCK_STREAM_CHUNK_CHARS = 12
+MOCK_RETRY_AFTER_MS = 200
+MEMORY_SAMPLE_INTERVAL = 0.25     # seconds
+SERVER_START_TIMEOUT = 15         # seconds
+BENCHMARK_API_KEY = 'sk-benchmark-not-a-real-key'
+
+# Generated entries are made-up words, so the server's near-duplicate filter
+# (checked against the real tables and everything accepted so far) keeps them
+MOCK_SYLLABLES = ('ar', 'bel', 'cor', 'dun', 'eth', 'fal', 'gor', 'hul', 'ith', 'kra', 'lom', 'mir',
+                  'nox', 'orl', 'pel', 'quen', 'rav', 'sul', 'tor', 'umb', 'vey', 'wyn', 'xal', 'zed')
+MALFORMED_KINDS = ('fenced', 'bracket_in_string', 'prose', 'prose_then_array', 'truncated')
+
+
+def parse_latency(spec):
+    """Turn a latency spec into a sampler returning seconds.
+
+    ``fixed:S``, ``uniform:LO,HI``, ``lognormal:MEDIAN,SIGMA`` or ``exp:MEAN``."""
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',') if v]
+    if kind == 'fixed' and len(values) == 1:
+        return lambda: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal' and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    if kind == 'exp' and len(values) == 1:
+        return lambda: random.expovariate(1.0 / values[0])
+    raise ValueError(f"Unknown latency spec '{spec}'")
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f"Unknown scenario '{name}' (choose from {', '.join(SCENARIOS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+# ---------------------------------------------------------------------------
+# Fixtures
+# ---------------------------------------------------------------------------
+
+def load_fixtures(directory=FIXTURE_DIR):
+    """One fixture per table: the file it came from plus its existing rows."""
+    fixtures = []
+    for path in sorted(Path(directory).glob('*/*.json')):
+        with open(path, encoding='utf-8') as f:
+            tables = json.load(f)
+        for table in tables:
+            rows = [row.get('result') for row in table.get('tableData', []) if row.get('result')]
+            fixtures.append({
+                'context_name': path.stem.replace('-', ' ').title(),
+                'context_type': (table.get('category') or path.parent.name.rstrip('s')).lower(),
+                'description': table.get('description', ''),
+                'table_name': table.get('name', ''),
+                'table_type': table_type_from_name(table.get('oracle_type') or table.get('name')),
+                'rows': rows,
+            })
+    if not fixtures:
+        raise SystemExit(f"No table fixtures found under {directory}")
+    return fixtures
+
+
+# ---------------------------------------------------------------------------
+# Mock OpenAI server
+# ---------------------------------------------------------------------------
+
+class MockStats:
+    """Counters kept by the mock upstream."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def inc(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+class MockOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    """Minimal /v1/chat/completions: sampled latency, optional streaming,
+    injected 429s and deliberately malformed batch outputs."""
+
+    protocol_version = 'HTTP/1.1'
+    latency = staticmethod(lambda: 0.0)
+    rate_429 = 0.0
+    malformed_rate = 0.0
+    rows = ['A lantern gutters in a draft from nowhere']
+    stats = MockStats()
+    _counter = iter(range(1, 1 << 62))
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        self.stats.inc('requests')
+
+        if random.random() < self.rate_429:
+            self.stats.inc('injected_429')
+            self.send_body(429, {'error': {'message': 'Rate limit reached (injected)', 'type': 'requests'}},
+                           {'retry-after-ms': str(MOCK_RETRY_AFTER_MS)})
+            return
+
+        content, finish_reason = self.completion_for(request)
+        delay = self.latency()
+        if request.get('stream'):
+            self.stats.inc('streamed')
+            self.stream(content, finish_reason, delay)
+        else:
+            time.sleep(delay)
+            self.send_body(200, {
+                'id': f'chatcmpl-mock-{next(self._counter)}',
+                'object': 'chat.completion',
+                'model': request.get('model', 'mock'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                             'finish_reason': finish_reason}],
+                'usage': self.usage(request, content),
+            })
+
+    def completion_for(self, request):
+        messages = request.get('messages') or []
+        prompt = '\n'.join(str(m.get('content', '')) for m in messages)
+        match = re.search(r'EXACTLY (\d+)', prompt)
+        if not match:
+            return f"The omen points toward {random.choice(self.rows).lower()}.", 'stop'
+
+        entries = [self.entry() for _ in range(int(match.group(1)))]
+        if random.random() >= self.malformed_rate:
+            return json.dumps(entries), 'stop'
+
+        kind = random.choice(MALFORMED_KINDS)
+        self.stats.inc(f'malformed_{kind}')
+        if kind == 'fenced':
+            return '```json\n' + json.dumps(entries, indent=2) + '\n```', 'stop'
+        if kind == 'bracket_in_string':
+            # Leading prose defeats json.loads and the "]" trips a naive array regex
+            entries[0] = f"{entries[0]} [see ]the ledger]"
+            return 'Sure! ' + json.dumps(entries), 'stop'
+        if kind == 'prose_then_array':
+            # json.loads fails on the preamble, but the array itself is clean for regex extraction
+            return 'Here are your entries:\n' + json.dumps(entries), 'stop'
+        if kind == 'prose':
+            return 'Here are your entries:\n' + '\n'.join(f'- {entry}' for entry in entries), 'stop'
+        text = json.dumps(entries)
+        return text[:max(1, int(len(text) * 0.7))], 'length'
+
+    @staticmethod
+    def entry():
+        words = [''.join(random.choices(MOCK_SYLLABLES, k=random.randint(2, 3))) for _ in range(random.randint(5, 9))]
+        return ' '.join(words).capitalize()
+
+    def usage(self, request, content):
+        prompt_chars = sum(len(str(m.get('content', ''))) for m in request.get('messages') or [])
+        prompt_tokens = prompt_chars // 4
+        completion_tokens = len(content) // 4
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens}
+
+    def rate_limit_headers(self):
+        return {
+            'x-ratelimit-limit-requests': '10000',
+            'x-ratelimit-remaining-requests': '9999',
+            'x-ratelimit-reset-requests': '6ms',
+            'x-ratelimit-limit-tokens': '2000000',
+            'x-ratelimit-remaining-tokens': '1999000',
+            'x-ratelimit-reset-tokens': '30ms',
+        }
+
+    def send_body(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in {**self.rate_limit_headers(), **(headers or {})}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, content, finish_reason, delay):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in self.rate_limit_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def chunk(data):
+            event = f"data: {data}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(event):x}\r\n".encode('ascii') + event + b"\r\n")
+            self.wfile.flush()
+
+        pieces = [content[i:i + MOCK_STREAM_CHUNK_CHARS] for i in range(0, len(content), MOCK_STREAM_CHUNK_CHARS)]
+        # A third of the latency is time to first token, the rest is spread over the pieces
+        time.sleep(delay / 3)
+        gap = (delay * 2 / 3) / max(1, len(pieces))
+        for piece in pieces:
+            chunk(json.dumps({'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]}))
+            time.sleep(gap)
+        chunk(json.dumps({'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]}))
+        chunk(json.dumps({'choices': [], 'usage': {'prompt_tokens': 0, 'completion_tokens': len(content) // 4}}))
+        chunk('[DONE]')
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_mock_server(latency, rate_429, malformed_rate, rows):
+    handler = type('ConfiguredMockHandler', (MockOpenAIHandler,), {
+        'latency': staticmethod(latency),
+        'rate_429': rate_429,
+        'malformed_rate': malformed_rate,
+        'rows': rows or MockOpenAIHandler.rows,
+        'stats': MockStats(),
+    })
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-openai', daemon=True).start()
+    return server, handler.stats
+
+
+# ---------------------------------------------------------------------------
+# Server under test
+# ---------------------------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch_server(upstream_url, cache_dir, log_path=None):
+    # cache_dir keeps mock completions out of the real response cache and databases
+    port = free_port()
+    env = dict(os.environ,
+               ANVIL_CACHE_DIR=str(cache_dir),
+               ANVIL_PORT=str(port),
+               ANVIL_HOST='127.0.0.1',
+               ANVIL_UPSTREAM_BASE_URL=upstream_url,
+               ANVIL_LOG_LEVEL=os.environ.get('ANVIL_LOG_LEVEL', 'warning'))
+    output = open(log_path, 'a') if log_path else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, str(SERVER_SCRIPT)], cwd=str(SCRIPT_DIR), env=env,
+                               stdout=output, stderr=output)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited during startup with code {process.returncode}")
+        try:
+            status, _, _ = request(url, 'GET', '/api/stats', timeout=1)
+            if status == 200:
+                return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise SystemExit(f"Server did not come up on {url} within {SERVER_START_TIMEOUT}s")
+
+
+def rss_bytes(pid):
+    """Resident set size of a process, or None where it can't be read."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        output = subprocess.run(['ps', '-o', 'rss=', '-p', str(pid)], capture_output=True, text=True, timeout=2)
+        return int(output.stdout.strip()) * 1024
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+
+class MemorySampler:
+    """Polls the server's RSS in the background and keeps start/peak/end."""
+
+    def __init__(self, pid, interval=MEMORY_SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def start(self):
+        self._sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _sample(self):
+        value = rss_bytes(self.pid)
+        if value is not None:
+            self.samples.append(value)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def summary(self):
+        if not self.samples:
+            return None
+        return {'start': self.samples[0], 'peak': max(self.samples), 'end': self.samples[-1]}
+
+
+# ---------------------------------------------------------------------------
+# Load generator
+# ---------------------------------------------------------------------------
+
+def request(base_url, method, path, body=None, headers=None, timeout=120, stream=False):
+    """Send one request. Returns ``(status, body_bytes, ttfb_seconds)``."""
+    parsed = urllib.parse.urlsplit(base_url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+    try:
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        all_headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        all_headers.update(headers or {})
+        start = time.perf_counter()
+        connection.request(method, path, body=payload, headers=all_headers)
+        response = connection.getresponse()
+        ttfb = time.perf_counter() - start
+        if stream:
+            # Time to the first generated entry is what the user actually sees
+            chunks = []
+            first_entry = None
+            for line in response:
+                if first_entry is None and line.startswith(b'event: entry'):
+                    first_entry = time.perf_counter() - start
+                chunks.append(line)
+            return response.status, b''.join(chunks), first_entry or ttfb
+        return response.status, response.read(), ttfb
+    finally:
+        connection.close()
+
+
+def batch_body(fixture, stream=False):
+    return {
+        'table_type': fixture['table_type'],
+        'num_entries': random.choice((5, 10, 20)),
+        'model': 'gpt-4o-mini',
+        'domain_context': {
+            'name': fixture['context_name'],
+            'type': fixture['context_type'],
+            'description': fixture['description'],
+        },
+        'stream': stream,
+    }
+
+
+def chat_body(fixture):
+    row = random.choice(fixture['rows']) if fixture['rows'] else fixture['table_name']
+    return {
+        'model': 'gpt-4o-mini',
+        'messages': [
+            {'role': 'system', 'content': 'You interpret oracle rolls for a solo tabletop RPG.'},
+            {'role': 'user', 'content': f"In the {fixture['context_name']} {fixture['context_type']}, "
+                                        f"the {fixture['table_name']} roll came up: {row}. What happens?"},
+        ],
+    }
+
+
+SCENARIOS = {
+    'batch-generate': ('POST', '/api/batch-generate', lambda f: batch_body(f), False),
+    'batch-generate-stream': ('POST', '/api/batch-generate', lambda f: batch_body(f, stream=True), True),
+    'openai': ('POST', '/api/openai', chat_body, False),
+    'chat': ('POST', '/api/chat', chat_body, False),
+    'static': ('GET', '/', None, False),
+}
+
+
+def is_error(status, body, stream, expected_results=None):
+    """Failed status, an error payload or, for batch requests, fewer
+    results than ``expected_results``."""
+    if status != 200:
+        return True
+    if stream:
+        if b'event: error' in body:
+            return True
+        if expected_results is None:
+            return False
+        done = body.partition(b'event: done\n')[2].partition(b'\n')[0].removeprefix(b'data: ')
+        try:
+            return len(json.loads(done)['results']) < expected_results
+        except (ValueError, KeyError):
+            return True
+    if body[:1] == b'{':
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return True
+        if 'error' in payload:
+            return True
+        return expected_results is not None and len(payload.get('results', [])) < expected_results
+    return False
+
+
+class LoadGenerator:
+    """Runs the scenario mix on a fixed number of worker threads until the
+    duration elapses or the request budget is spent."""
+
+    def __init__(self, base_url, fixtures, mix, concurrency, duration=None, total_requests=None,
+                 use_cache=False, timeout=120):
+        self.base_url = base_url
+        self.fixtures = fixtures
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.concurrency = concurrency
+        self.duration = duration
+        self.total_requests = total_requests
+        self.timeout = timeout
+        self.headers = {'X-API-Key': BENCHMARK_API_KEY}
+        if not use_cache:
+            self.headers['X-Cache-Bypass'] = '1'
+        self._lock = threading.Lock()
+        self._issued = 0
+        self.results = {name: [] for name in self.names}
+        self.elapsed = 0.0
+
+    def _claim(self, deadline):
+        with self._lock:
+            if self.total_requests is not None and self._issued >= self.total_requests:
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            self._issued += 1
+            return True
+
+    def _worker(self, deadline):
+        while self._claim(deadline):
+            name = random.choices(self.names, self.weights)[0]
+            method, path, make_body, stream = SCENARIOS[name]
+            body = make_body(random.choice(self.fixtures)) if make_body else None
+            start = time.perf_counter()
+            try:
+                status, data, ttfb = request(self.base_url, method, path, body, self.headers, self.timeout, stream)
+                expected = body.get('num_entries') if body else None
+                record = (time.perf_counter() - start, ttfb, status, is_error(status, data, stream, expected))
+            except OSError:
+                record = (time.perf_counter() - start, None, 0, True)
+            with self._lock:
+                self.results[name].append(record)
+
+    def run(self):
+        deadline = time.monotonic() + self.duration if self.duration and self.total_requests is None else None
+        threads = [threading.Thread(target=self._worker, args=(deadline,), name=f'load-{i}', daemon=True)
+                   for i in range(self.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+
+
+# ---------------------------------------------------------------------------
+# Report
+# ---------------------------------------------------------------------------
+
+def summarize(records, elapsed):
+    latencies = sorted(r[0] for r in records)
+    ttfbs = sorted(r[1] for r in records if r[1] is not None)
+    return {
+        'requests': len(records),
+        'errors': sum(1 for r in records if r[3]),
+        'busy_503': sum(1 for r in records if r[2] == 503),
+        'rps': round(len(records) / elapsed, 2) if elapsed else 0.0,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+        'ttfb_p50': percentile(ttfbs, 0.50),
+    }
+
+
+def build_report(generator, memory, mock_stats, server_metrics, config):
+    endpoints = {name: summarize(records, generator.elapsed) for name, records in generator.results.items()}
+    everything = [r for records in generator.results.values() for r in records]
+    parse_paths = {}
+    for counter in (server_metrics or {}).get('counters', {}).get('anvil_batch_parse_total', []):
+        parse_paths[counter['labels'].get('path')] = counter['value']
+    return {
+        'config': config,
+        'elapsed_seconds': round(generator.elapsed, 2),
+        'overall': summarize(everything, generator.elapsed),
+        'endpoints': endpoints,
+        'server_memory_bytes': memory,
+        'mock_upstream': dict(mock_stats.counts) if mock_stats else None,
+        'batch_parse_paths': parse_paths,
+    }
+
+
+def format_ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+def format_mb(value):
+    return '-' if value is None else f'{value / (1024 * 1024):.1f} MB'
+
+
+def print_report(report):
+    print(f"\nRan {report['overall']['requests']} requests in {report['elapsed_seconds']}s "
+          f"({report['config']['concurrency']} concurrent)")
+    columns = ('requests', 'errors', 'busy_503', 'rps', 'p50', 'p95', 'p99', 'max', 'ttfb_p50')
+    print(f"{'scenario':<24}" + ''.join(f'{c:>10}' for c in columns))
+    rows = list(report['endpoints'].items()) + [('TOTAL', report['overall'])]
+    for name, stats in rows:
+        cells = []
+        for column in columns:
+            value = stats[column]
+            cells.append(format_ms(value) if column in ('p50', 'p95', 'p99', 'max', 'ttfb_p50') else str(value))
+        print(f"{name:<24}" + ''.join(f'{c:>10}' for c in cells))
+    print("(latencies in ms; ttfb_p50 is time to first entry for streaming requests)")
+
+    memory = report['server_memory_bytes']
+    if memory:
+        print(f"\nServer RSS: start {format_mb(memory['start'])}, peak {format_mb(memory['peak'])}, "
+              f"end {format_mb(memory['end'])}")
+    if report['mock_upstream']:
+        print(f"Mock upstream: {json.dumps(report['mock_upstream'], sort_keys=True)}")
+    if report['batch_parse_paths']:
+        print(f"Batch parse paths: {json.dumps(report['batch_parse_paths'], sort_keys=True)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark standalone_server.py against a mock OpenAI API')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='seconds to run')
+    parser.add_argument('--requests', type=int, help='stop after this many requests instead of a duration')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'weighted scenarios (default: {DEFAULT_MIX})')
+    parser.add_argument('--latency', default=DEFAULT_LATENCY,
+                        help='mock upstream latency: fixed:S, uniform:LO,HI, lognormal:MEDIAN,SIGMA or exp:MEAN')
+    parser.add_argument('--rate-429', type=float, default=DEFAULT_RATE_429, help='fraction of upstream calls answered 429')
+    parser.add_argument('--malformed-rate', type=float, default=DEFAULT_MALFORMED_RATE,
+                        help='fraction of batch completions that are fenced, truncated, prose, etc.')
+    parser.add_argument('--use-cache', action='store_true', help="don't send X-Cache-Bypass")
+    parser.add_argument('--server-url', help='benchmark an already running server instead of launching one')
+    parser.add_argument('--server-pid', type=int, help='pid of --server-url for memory sampling')
+    parser.add_argument('--server-log', help='file to append the launched server output to')
+    parser.add_argument('--fixtures', default=str(FIXTURE_DIR), help='directory of aspect/domain table files')
+    parser.add_argument('--seed', type=int, help='seed the scenario and mock randomness')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    fixtures = load_fixtures(args.fixtures)
+    rows = [row for fixture in fixtures for row in fixture['rows']]
+
+    mock, mock_stats, process, cache_dir = None, None, None, None
+    if args.server_url:
+        base_url, pid = args.server_url.rstrip('/'), args.server_pid
+    else:
+        mock, mock_stats = start_mock_server(parse_latency(args.latency), args.rate_429, args.malformed_rate, rows)
+        cache_dir = tempfile.mkdtemp(prefix='anvil-benchmark-')
+        try:
+            process, base_url = launch_server(f'http://127.0.0.1:{mock.server_address[1]}', cache_dir, args.server_log)
+        except SystemExit:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            raise
+        pid = process.pid
+
+    memory = MemorySampler(pid) if pid else None
+    try:
+        if memory:
+            memory.start()
+        generator = LoadGenerator(base_url, fixtures, mix, args.concurrency, args.duration, args.requests,
+                                  use_cache=args.use_cache)
+        generator.run()
+        if memory:
+            memory.stop()
+        try:
+            status, body, _ = request(base_url, 'GET', '/api/metrics?format=json', timeout=5)
+            server_metrics = json.loads(body) if status == 200 else None
+        except (OSError, ValueError):
+            server_metrics = None
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=10)
+        if mock:
+            mock.shutdown()
+        if cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    config = {key: value for key, value in vars(args).items() if key not in ('json',)}
+    report = build_report(generator, memory.summary() if memory else None, mock_stats, server_metrics, config)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,57 +8,3759 @@ import http.server
 import socketserver
 import json
 import urllib.parse
-import urllib.request
-import urllib.error
 import base64
+import copy
+import email.utils
+import gzip
+import http.client
+import hashlib
 import os
+import heapq
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import brotli  # optional: enables br-encoded static assets
+except ImportError:
+    brotli = None
+
+try:
+    import numpy  # optional: vectorised bulk rolls for /api/roll
+except ImportError:
+    numpy = None
+
 # Configuration
-PORT = 5000
-HOST = 'localhost'
+PORT = int(os.environ.get('ANVIL_PORT', 5000))
+HOST = os.environ.get('ANVIL_HOST', 'localhost')
+
+# Concurrency: 'pooled' serves requests on a bounded worker pool, 'single'
+# keeps the old one-connection-at-a-time TCPServer behaviour.
+SERVER_MODE = 'pooled'
+MAX_WORKERS = 16
+MAX_QUEUE_DEPTH = 64          # accepted connections waiting for a worker
+RETRY_AFTER_SECONDS = 5       # sent with 503 responses when saturated
+
+# Per-endpoint concurrency limits. Requests beyond the limit wait up to
+# ENDPOINT_WAIT_SECONDS for a slot before being turned away with a 503.
+ENDPOINT_CONCURRENCY = {
+    '/api/batch-generate': 4,
+    '/api/generate-file': 2,
+    '/api/batch-review': 2,
+    '/api/roll': 4,
+    '/api/chat': 8,
+    '/api/openai': 8,
+}
+ENDPOINT_WAIT_SECONDS = 2.0
+
+# Upstream (OpenAI-compatible) API. Point ANVIL_UPSTREAM_BASE_URL at a local
+# mock server to exercise the proxy without spending API quota.
+UPSTREAM_BASE_URL = os.environ.get('ANVIL_UPSTREAM_BASE_URL', 'https://api.openai.com')
+UPSTREAM_CHAT_PATH = '/v1/chat/completions'
+UPSTREAM_POOL_SIZE = 8            # idle keep-alive connections kept around
+UPSTREAM_CONNECT_TIMEOUT = 10     # seconds
+UPSTREAM_READ_TIMEOUT = 180       # seconds; batch generation can be slow
+
+# Upstream scheduling. Each API key gets request and token buckets fed by the
+# x-ratelimit-* response headers; 429/5xx answers are retried with jittered
+# exponential backoff (or the server's Retry-After). Lower priority numbers
+# are dispatched first when a key is saturated.
+UPSTREAM_MAX_RETRIES = 4
+UPSTREAM_BACKOFF_BASE = 1.0       # seconds
+UPSTREAM_BACKOFF_MAX = 30.0       # seconds
+UPSTREAM_RETRY_STATUSES = {429, 500, 502, 503, 504}
+PRIORITY_INTERACTIVE = 0
+PRIORITY_STANDARD = 1
+PRIORITY_BULK = 2
+ENDPOINT_PRIORITY = {
+    '/api/chat': PRIORITY_INTERACTIVE,
+    '/api/openai': PRIORITY_STANDARD,
+    '/api/batch-generate': PRIORITY_STANDARD,
+    '/api/generate-file': PRIORITY_BULK,
+    '/api/batch-review': PRIORITY_BULK,
+}
+
+# Response cache, corpus database and job database all live under CACHE_DIR.
+CACHE_DIR = Path(os.environ.get('ANVIL_CACHE_DIR', Path(__file__).resolve().parent / '.cache'))
+
+# Response cache for /api/batch-generate, keyed on the rendered OpenAI request.
+# Send "X-Cache-Bypass: 1" (or "Cache-Control: no-cache") to force a fresh call.
+RESPONSE_CACHE_DIR = CACHE_DIR / 'batch-generate'
+RESPONSE_CACHE_MEMORY_ENTRIES = 256
+RESPONSE_CACHE_DISK_MAX_BYTES = 50 * 1024 * 1024
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# Batch sizing. Completion budgets are estimated from the table type's word
+# count; requests that would exceed MAX_REQUEST_TOKENS (prompt + completion)
+# or MAX_ENTRIES_PER_REQUEST are split into parallel sub-batches.
+TOKENS_PER_WORD = 1.4
+ENTRY_OVERHEAD_TOKENS = 4         # quotes, comma and space around each entry
+ARRAY_OVERHEAD_TOKENS = 16        # brackets and a possible ```json fence
+COMPLETION_SAFETY_MARGIN = 1.3
+REASONING_ALLOWANCE_TOKENS = 1500  # extra room for gpt-5 reasoning tokens
+MAX_REQUEST_TOKENS = 4000
+MAX_ENTRIES_PER_REQUEST = 25
+BATCH_SPLIT_CONCURRENCY = 4
+BATCH_TOPUP_ROUNDS = 2            # follow-up requests to replace dropped duplicates
+
+# Single-flight coalescing: identical upstream payloads that arrive while an
+# earlier one is still in flight wait for and share its result. Turn it off
+# per endpoint where every call should produce fresh variety. Requests sent
+# with X-Cache-Bypass are never coalesced.
+COALESCE_ENDPOINTS = {
+    '/api/batch-generate': True,
+    '/api/generate-file': True,
+    '/api/chat': True,
+    '/api/openai': True,
+}
+
+# Whole-file generation (/api/generate-file): how many tables of one
+# aspect/domain file are generated in parallel.
+FANOUT_CONCURRENCY = 6
+
+# Batched review (/api/batch-review): rows are packed into upstream calls of
+# at most REVIEW_CHUNK_TOKEN_BUDGET estimated prompt tokens / REVIEW_MAX_ROWS
+# rows, and up to REVIEW_CONCURRENCY chunks run at once.
+REVIEW_CHUNK_TOKEN_BUDGET = 1500
+REVIEW_MAX_ROWS = 25
+REVIEW_CONCURRENCY = 4
+
+# Near-duplicate filtering. Every result string in the table corpus is indexed
+# at startup (character shingles -> MinHash -> LSH buckets); generated entries
+# whose shingle Jaccard similarity to an existing or already accepted entry
+# reaches NEAR_DUPLICATE_THRESHOLD are dropped and the shortfall re-requested.
+# Accepted entries join the index too (source "generated", newest
+# GENERATED_INDEX_MAX_ENTRIES kept), so later tables and requests avoid them.
+CORPUS_DIR = Path(os.environ.get('ANVIL_CORPUS_DIR', Path(__file__).resolve().parent.parent / 'electron' / 'tables'))
+NEAR_DUPLICATE_THRESHOLD = 0.6
+SHINGLE_SIZE = 4                  # characters
+MINHASH_PERMUTATIONS = 48
+LSH_BANDS = 16                    # 3 rows per band: ~98% recall at the threshold
+GENERATED_INDEX_MAX_ENTRIES = 5000
+
+# Table rolling (/api/roll). Tables under CORPUS_DIR are compiled into dense
+# roll -> row lookup arrays and recompiled when their files change. Bulk rolls
+# use NumPy when it is installed and return hit histograms instead of every
+# individual roll.
+ROLL_MAX_COUNT = 10_000_000
+ROLL_MAX_DETAILED = 1000          # rolls returned individually, with macro expansions
+ROLL_MAX_MACRO_DEPTH = 3
+ROLL_MAX_MACRO_DEPTH_LIMIT = 10
+ROLL_CHUNK_SIZE = 1_000_000       # draws per NumPy batch, bounds memory use
+ROLL_REFRESH_SECONDS = 2.0
+
+# Table corpus (/api/tables, /api/search). The JSON tables under CORPUS_DIR
+# are compiled into a SQLite database with an FTS5 index; only files whose
+# size/mtime and content hash changed are re-parsed.
+CORPUS_DB_PATH = CACHE_DIR / 'corpus.sqlite3'
+CORPUS_REFRESH_SECONDS = 2.0
+SEARCH_MAX_RESULTS = 100
+
+# Background jobs (/api/jobs). Generation and review work submitted as a job
+# runs on a worker pool and is checkpointed per table in JOBS_DB_PATH, so a
+# refresh or restart never repeats finished tables. API keys are not written
+# to disk: after a restart jobs resume with OPENAI_API_KEY if it is set, and
+# otherwise wait as 'paused' until POST /api/jobs/<id>/resume supplies a key.
+JOBS_DB_PATH = CACHE_DIR / 'jobs.sqlite3'
+JOB_WORKERS = 2
+JOB_HISTORY_LIMIT = 50
+
+# Table files (/api/table-files/<aspects|domains>/<name>). Files under
+# CORPUS_DIR can be loaded and saved directly: PUT replaces a file, PATCH takes
+# JSON Patch or row edits, both guarded by If-Match ETags. Edits are applied
+# in memory and written behind (atomic rename + fsync) once a file has been
+# quiet for TABLE_WRITE_DELAY_SECONDS, at most TABLE_WRITE_MAX_DELAY_SECONDS
+# after its first unsaved edit. Request and response bodies may be gzipped.
+TABLE_WRITE_DELAY_SECONDS = 0.5
+TABLE_WRITE_MAX_DELAY_SECONDS = 2.0
+MAX_REQUEST_BODY_BYTES = 20 * 1024 * 1024   # after gzip decoding
+
+# Static files. Text assets up to STATIC_CACHE_MAX_FILE_BYTES are kept in memory
+# with gzip (and brotli, if installed) variants, and re-read only when their
+# mtime changes. Larger files and binaries are streamed with sendfile and
+# support Range requests.
+STATIC_CACHE_MAX_FILE_BYTES = 2 * 1024 * 1024
+STATIC_COMPRESS_MIN_BYTES = 1024
+STATIC_PRECOMPRESS_MAX_FILES = 500
+STATIC_COMPRESSIBLE_EXTENSIONS = {
+    '.html', '.htm', '.js', '.mjs', '.css', '.json', '.svg', '.txt', '.md', '.map', '.xml', '.wasm',
+}
+STATIC_SKIP_DIRS = {'node_modules', '__pycache__'}
+STATIC_MAX_AGE_SECONDS = 3600     # HTML is always revalidated
+
+# Logging. Events are written as JSON lines by a background thread so request
+# handlers never wait on the terminal or disk. Full prompt/completion dumps are
+# debug events, sampled at LOG_PAYLOAD_SAMPLE_RATE; long strings are cut to
+# LOG_MAX_FIELD_CHARS and API keys are always redacted.
+LOG_LEVEL = os.environ.get('ANVIL_LOG_LEVEL', 'info')
+LOG_FILE = os.environ.get('ANVIL_LOG_FILE')  # default: stderr
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('ANVIL_LOG_PAYLOAD_SAMPLE_RATE', '0.1'))
+LOG_MAX_FIELD_CHARS = 2000
+LOG_QUEUE_SIZE = 10000            # records beyond this are dropped, not waited on
+
+# Latency histogram buckets (seconds) used by /api/metrics
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+CORS_ALLOW_HEADERS = 'Content-Type, Content-Encoding, If-Match, If-None-Match, X-API-Key, X-API-Key-Encoded, X-Cache-Bypass'
+
+
+class JsonLogger:
+    """Leveled JSON-lines logger. Callers only enqueue a record; redaction,
+    truncation, serialisation and the write happen on a background thread.
+    When the queue is full records are dropped and counted instead of
+    blocking the request."""
+
+    LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+    REDACT_FIELDS = {'api_key', 'authorization', 'x-api-key', 'x-api-key-encoded'}
+    # OpenAI keys, bearer tokens and base64 encodings of them ("sk-" -> "c2st")
+    SECRET_PATTERN = re.compile(r'(?:sk-[A-Za-z0-9_\-]{8,}|\bc2st[A-Za-z0-9+/]{12,}={0,2})')
+
+    def __init__(self, level='info', path=None, payload_sample_rate=0.1, max_field_chars=2000, queue_size=10000):
+        self.threshold = self.LEVELS.get(str(level).lower(), self.LEVELS['info'])
+        self.path = path
+        self.payload_sample_rate = payload_sample_rate
+        self.max_field_chars = max_field_chars
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        threading.Thread(target=self._run, name='anvil-log', daemon=True).start()
+
+    def enabled(self, level):
+        return self.LEVELS[level] >= self.threshold
+
+    def log(self, level, event, **fields):
+        if not self.enabled(level):
+            return
+        record = {'ts': round(time.time(), 3), 'level': level, 'event': event}
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, event, **fields):
+        self.log('debug', event, **fields)
+
+    def info(self, event, **fields):
+        self.log('info', event, **fields)
+
+    def warning(self, event, **fields):
+        self.log('warning', event, **fields)
+
+    def error(self, event, **fields):
+        self.log('error', event, **fields)
+
+    def payload(self, event, **fields):
+        """Debug dump of a full prompt or completion, sampled."""
+        if self.enabled('debug') and random.random() < self.payload_sample_rate:
+            self.log('debug', event, **fields)
+
+    def flush(self, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def redact(self, text):
+        return self.SECRET_PATTERN.sub(lambda m: m.group(0)[:4] + '...[redacted]', text)
+
+    def _sanitize(self, value, key=None):
+        if key is not None and str(key).lower() in self.REDACT_FIELDS and value:
+            return '[redacted]'
+        if isinstance(value, dict):
+            return {k: self._sanitize(v, k) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._sanitize(v) for v in value]
+        if isinstance(value, (bytes, bytearray)):
+            value = value.decode('utf-8', 'replace')
+        if isinstance(value, str):
+            value = self.redact(value)
+            if len(value) > self.max_field_chars:
+                value = f"{value[:self.max_field_chars]}...[{len(value) - self.max_field_chars} more chars]"
+        return value
+
+    def _run(self):
+        stream = open(self.path, 'a', encoding='utf-8') if self.path else sys.stderr
+        while True:
+            record = self._queue.get()
+            try:
+                stream.write(json.dumps(self._sanitize(record), default=str) + '\n')
+                if self._queue.empty():
+                    stream.flush()
+            except Exception:
+                pass
+            finally:
+                self._queue.task_done()
+
+
+log = JsonLogger(LOG_LEVEL, LOG_FILE, LOG_PAYLOAD_SAMPLE_RATE, LOG_MAX_FIELD_CHARS, LOG_QUEUE_SIZE)
+
+
+class Metrics:
+    """Thread-safe in-process counters, histograms and gauges.
+
+    Rendered as Prometheus text or JSON by /api/metrics. Gauges are callbacks
+    evaluated at scrape time, so components only pay for instrumentation on
+    the paths they already run."""
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, amount=1, help_text=None):
+        key = (name, self._labels(labels))
+        with self._lock:
+            if help_text:
+                self._help.setdefault(name, help_text)
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None, help_text=None):
+        key = (name, self._labels(labels))
+        with self._lock:
+            if help_text:
+                self._help.setdefault(name, help_text)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def gauge(self, name, fn, help_text=None):
+        """Register ``fn`` returning a number or a ``{labels_dict_items: value}`` mapping."""
+        with self._lock:
+            self._gauges[name] = fn
+            if help_text:
+                self._help[name] = help_text
+
+    def _snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']}
+                          for key, h in self._histograms.items()}
+            gauges = dict(self._gauges)
+            help_texts = dict(self._help)
+        gauge_values = {}
+        for name, fn in gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if isinstance(value, dict):
+                for labels, item in value.items():
+                    gauge_values[(name, tuple(labels))] = item
+            else:
+                gauge_values[(name, ())] = value
+        return counters, histograms, gauge_values, help_texts
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def render_prometheus(self):
+        counters, histograms, gauges, help_texts = self._snapshot()
+        lines = []
+        seen = set()
+
+        def header(name, metric_type):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in help_texts:
+                lines.append(f'# HELP {name} {help_texts[name]}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{self._format_labels(labels)} {value}')
+        for (name, labels), histogram in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{self._format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+            lines.append(f'{name}_sum{self._format_labels(labels)} {histogram["sum"]:.6f}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {histogram["count"]}')
+        for (name, labels), value in sorted(gauges.items(), key=lambda item: (item[0][0], item[0][1])):
+            header(name, 'gauge')
+            lines.append(f'{name}{self._format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _quantile(self, histogram, q):
+        if not histogram['count']:
+            return None
+        rank = q * histogram['count']
+        cumulative = 0
+        for bound, count in zip(self.buckets, histogram['buckets']):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def as_json(self):
+        counters, histograms, gauges, _ = self._snapshot()
+        result = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        for (name, labels), value in counters.items():
+            result['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in histograms.items():
+            result['histograms'].setdefault(name, []).append({
+                'labels': dict(labels),
+                'count': histogram['count'],
+                'sum': round(histogram['sum'], 6),
+                'mean': round(histogram['sum'] / histogram['count'], 6) if histogram['count'] else None,
+                'p50': self._quantile(histogram, 0.5),
+                'p95': self._quantile(histogram, 0.95),
+                'p99': self._quantile(histogram, 0.99),
+                'buckets': dict(zip((str(b) for b in self.buckets), histogram['buckets'])),
+            })
+        for (name, labels), value in gauges.items():
+            result['gauges'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return result
+
+
+metrics = Metrics()
+metrics.gauge('anvil_log_dropped_records', lambda: log.dropped, 'Log records dropped because the writer fell behind')
+
+
+def record_usage(model, table_type, usage):
+    if not usage:
+        return
+    labels = {'model': model or 'unknown', 'table_type': table_type or 'none'}
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if usage.get(kind):
+            metrics.inc(f'anvil_upstream_{kind}_total', labels, usage[kind],
+                        help_text=f'OpenAI {kind.replace("_", " ")} by model and table type')
+
+
+class EndpointLimiter:
+    """Caps how many requests may run concurrently for each endpoint."""
+
+    def __init__(self, limits, wait_seconds):
+        self.wait_seconds = wait_seconds
+        self._semaphores = {
+            path: threading.BoundedSemaphore(limit) for path, limit in limits.items()
+        }
+        self._lock = threading.Lock()
+        self._in_flight = {path: 0 for path in limits}
+
+    def acquire(self, path):
+        semaphore = self._semaphores.get(path)
+        if semaphore is None:
+            return True
+        if not semaphore.acquire(timeout=self.wait_seconds):
+            metrics.inc('anvil_endpoint_rejected_total', {'endpoint': path},
+                        help_text='Requests turned away because the endpoint was at its concurrency limit')
+            return False
+        with self._lock:
+            self._in_flight[path] += 1
+        return True
+
+    def release(self, path):
+        semaphore = self._semaphores.get(path)
+        if semaphore is not None:
+            with self._lock:
+                self._in_flight[path] -= 1
+            semaphore.release()
+
+    def in_flight(self):
+        with self._lock:
+            return {(('endpoint', path),): count for path, count in self._in_flight.items()}
+
+
+endpoint_limiter = EndpointLimiter(ENDPOINT_CONCURRENCY, ENDPOINT_WAIT_SECONDS)
+metrics.gauge('anvil_endpoint_in_flight', endpoint_limiter.in_flight, 'Requests currently running per limited endpoint')
+
+
+def parse_reset_duration(value):
+    """Parse OpenAI reset durations such as ``"1s"``, ``"6m0s"`` or ``"20ms"``."""
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    matches = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not matches:
+        return None
+    for number, unit in matches:
+        total += float(number) * units[unit]
+    return total
+
+
+def parse_retry_after(headers):
+    if headers is None:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class TokenBucket:
+    """A bucket whose level and refill rate come from rate limit headers.
+
+    ``limit``/``remaining``/``reset`` describe the server's view; the
+    bucket refills linearly from ``remaining`` to ``limit`` over ``reset``
+    seconds and is drained locally as requests are dispatched."""
+
+    def __init__(self):
+        self.capacity = None
+        self.level = None
+        self.rate = None
+        self.updated = time.monotonic()
+
+    def sync(self, limit, remaining, reset_seconds):
+        if limit is None or remaining is None:
+            return
+        self.capacity = limit
+        self.level = remaining
+        missing = max(0, limit - remaining)
+        if reset_seconds and missing:
+            self.rate = missing / reset_seconds
+        else:
+            self.rate = limit / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.level is None:
+            return
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        if self.level is None:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate if self.rate else 1.0
+
+    def consume(self, amount, now):
+        if self.level is not None:
+            self._refill(now)
+            self.level -= min(amount, self.capacity)
+
+    def drain(self, now):
+        if self.level is not None:
+            self._refill(now)
+            self.level = min(self.level, 0)
+
+
+class UpstreamScheduler:
+    """Paces upstream calls per API key and retries rate limited ones.
+
+    Callers queue per key in (priority, arrival) order. The head of the queue
+    is dispatched once both the request and token buckets have room and any
+    Retry-After pause has passed."""
+
+    class _KeyState:
+        def __init__(self):
+            self.requests = TokenBucket()
+            self.tokens = TokenBucket()
+            self.blocked_until = 0.0
+            self.waiting = []
+
+    def __init__(self, max_retries=UPSTREAM_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._states = {}
+        self._sequence = 0
+        self.retries = 0
+
+    @staticmethod
+    def _key_id(api_key):
+        # Never keep raw keys around as dictionary keys
+        return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+    def _state(self, api_key):
+        key_id = self._key_id(api_key)
+        state = self._states.get(key_id)
+        if state is None:
+            state = self._states[key_id] = self._KeyState()
+        return state
+
+    def acquire(self, api_key, priority, estimated_tokens):
+        with self._cond:
+            state = self._state(api_key)
+            self._sequence += 1
+            ticket = (priority, self._sequence)
+            heapq.heappush(state.waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if state.waiting[0] == ticket:
+                        wait = max(
+                            state.blocked_until - now,
+                            state.requests.wait_time(1, now),
+                            state.tokens.wait_time(estimated_tokens, now),
+                        )
+                        if wait <= 0:
+                            state.requests.consume(1, now)
+                            state.tokens.consume(estimated_tokens, now)
+                            return
+                        self._cond.wait(min(wait, 1.0))
+                    else:
+                        self._cond.wait(1.0)
+            finally:
+                state.waiting.remove(ticket)
+                heapq.heapify(state.waiting)
+                self._cond.notify_all()
+
+    def update(self, api_key, headers):
+        if headers is None:
+            return
+
+        def number(name):
+            value = headers.get(name)
+            try:
+                return int(value) if value is not None else None
+            except ValueError:
+                return None
+
+        with self._cond:
+            state = self._state(api_key)
+            state.requests.sync(number('x-ratelimit-limit-requests'), number('x-ratelimit-remaining-requests'),
+                                parse_reset_duration(headers.get('x-ratelimit-reset-requests')))
+            state.tokens.sync(number('x-ratelimit-limit-tokens'), number('x-ratelimit-remaining-tokens'),
+                              parse_reset_duration(headers.get('x-ratelimit-reset-tokens')))
+            self._cond.notify_all()
+
+    def block(self, api_key, seconds):
+        with self._cond:
+            state = self._state(api_key)
+            now = time.monotonic()
+            state.blocked_until = max(state.blocked_until, now + seconds)
+            state.requests.drain(now)
+
+    @staticmethod
+    def backoff(attempt):
+        # Full jitter: anywhere between 0 and the capped exponential delay
+        return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+
+    @staticmethod
+    def is_retryable(error):
+        if error.code not in UPSTREAM_RETRY_STATUSES:
+            return False
+        # Running out of quota is a 429 too, but waiting won't fix it
+        return b'insufficient_quota' not in (error.body or b'')
+
+    def run(self, api_key, priority, estimated_tokens, fn):
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            self.acquire(api_key, priority, estimated_tokens)
+            metrics.observe('anvil_scheduler_wait_seconds', time.perf_counter() - start, {'priority': str(priority)},
+                            help_text='Time upstream calls waited for their API key to have rate limit room')
+            try:
+                result = fn()
+            except UpstreamHTTPError as e:
+                self.update(api_key, e.headers)
+                if attempt >= self.max_retries or not self.is_retryable(e):
+                    raise
+                retry_after = parse_retry_after(e.headers)
+                if retry_after is not None:
+                    delay = retry_after + random.uniform(0, min(1.0, retry_after * 0.1))
+                else:
+                    delay = self.backoff(attempt)
+                if e.code == 429:
+                    self.block(api_key, delay)
+                with self._cond:
+                    self.retries += 1
+                metrics.inc('anvil_upstream_retries_total', {'status': str(e.code)},
+                            help_text='Upstream calls retried after a 429/5xx answer')
+                log.warning('upstream_retry', status=e.code, delay=round(delay, 2),
+                            attempt=attempt + 1, max_retries=self.max_retries)
+                time.sleep(delay)
+                continue
+            self.update(api_key, getattr(result, 'headers', None))
+            return result
+
+    def stats(self):
+        with self._cond:
+            return {
+                'keys': len(self._states),
+                'waiting': sum(len(state.waiting) for state in self._states.values()),
+                'retries': self.retries,
+            }
+
+
+class UpstreamHTTPError(Exception):
+    """Raised when the upstream API answers with a 4xx/5xx status."""
+
+    def __init__(self, code, reason, headers, body):
+        super().__init__(f'HTTP Error {code}: {reason}')
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class UpstreamResponse:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+class UpstreamClient:
+    """Small keep-alive connection pool for the upstream chat completions API.
+
+    Connections are HTTP/1.1 and returned to the pool once their response has
+    been fully read, so consecutive calls skip DNS, TCP and TLS setup."""
+
+    def __init__(self, base_url, pool_size=UPSTREAM_POOL_SIZE,
+                 connect_timeout=UPSTREAM_CONNECT_TIMEOUT, read_timeout=UPSTREAM_READ_TIMEOUT, scheduler=None):
+        self.scheduler = scheduler or UpstreamScheduler()
+        parsed = urllib.parse.urlsplit(base_url)
+        self.scheme = parsed.scheme or 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        start = time.perf_counter()
+        conn.connect()
+        metrics.observe('anvil_upstream_connect_seconds', time.perf_counter() - start,
+                        help_text='Time to open a new upstream connection (DNS, TCP and TLS)')
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _send(self, path, payload, api_key, accept):
+        body = json.dumps(payload).encode('utf-8')
+        headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            'Accept': accept,
+        }
+        conn, reused = self._acquire()
+        metrics.inc('anvil_upstream_connections_total', {'reused': str(reused).lower()},
+                    help_text='Upstream requests by whether they reused a pooled connection')
+        try:
+            try:
+                start = time.perf_counter()
+                conn.request('POST', self.base_path + path, body=body, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server dropped an idle keep-alive connection; retry once on a fresh one
+                conn.close()
+                if not reused:
+                    raise
+                conn = self._new_connection()
+                start = time.perf_counter()
+                conn.request('POST', self.base_path + path, body=body, headers=headers)
+                response = conn.getresponse()
+        except Exception:
+            conn.close()
+            metrics.inc('anvil_upstream_responses_total', {'status': 'error'},
+                        help_text='Upstream responses by HTTP status')
+            raise
+        kind = 'stream' if accept == 'text/event-stream' else 'json'
+        metrics.observe('anvil_upstream_ttfb_seconds', time.perf_counter() - start, {'kind': kind},
+                        help_text='Time from sending an upstream request to receiving its response headers')
+        metrics.inc('anvil_upstream_responses_total', {'status': str(response.status)},
+                    help_text='Upstream responses by HTTP status')
+        return conn, response
+
+    def _finish(self, conn, response):
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+
+    def post_json(self, path, payload, api_key):
+        start = time.perf_counter()
+        conn, response = self._send(path, payload, api_key, 'application/json')
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._finish(conn, response)
+        metrics.observe('anvil_upstream_duration_seconds', time.perf_counter() - start,
+                        help_text='Total time of non-streaming upstream calls, including the body')
+
+        if response.status >= 400:
+            raise UpstreamHTTPError(response.status, response.reason, response.headers, data)
+        return UpstreamResponse(response.status, response.headers, data)
+
+    def stream_json(self, path, payload, api_key):
+        """Open a server-sent event stream.
+
+        Errors are raised before anything is returned, so a failed stream can
+        be retried. The returned UpstreamStream yields decoded ``data:``
+        events; its connection only goes back to the pool if it is read to
+        the end."""
+        conn, response = self._send(path, payload, api_key, 'text/event-stream')
+        if response.status >= 400:
+            try:
+                data = response.read()
+            except Exception:
+                conn.close()
+                raise
+            self._finish(conn, response)
+            raise UpstreamHTTPError(response.status, response.reason, response.headers, data)
+        return UpstreamStream(self, conn, response)
+
+    @staticmethod
+    def estimate_request_tokens(payload):
+        # Rate limits count the prompt plus the requested completion budget
+        return estimate_prompt_tokens(payload) + (payload.get('max_tokens') or payload.get('max_completion_tokens') or 0)
+
+    def chat_completion(self, payload, api_key, priority=PRIORITY_STANDARD):
+        return self.scheduler.run(api_key, priority, self.estimate_request_tokens(payload),
+                                  lambda: self.post_json(UPSTREAM_CHAT_PATH, payload, api_key))
+
+    def stream_chat_completion(self, payload, api_key, priority=PRIORITY_STANDARD):
+        return self.scheduler.run(api_key, priority, self.estimate_request_tokens(payload),
+                                  lambda: self.stream_json(UPSTREAM_CHAT_PATH, payload, api_key))
+
+
+class UpstreamStream:
+    def __init__(self, client, conn, response):
+        self.client = client
+        self.conn = conn
+        self.response = response
+        self.headers = response.headers
+
+    def __iter__(self):
+        completed = False
+        try:
+            while True:
+                line = self.response.readline()
+                if not line:
+                    completed = True
+                    break
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue
+                event = line[5:].strip()
+                if event == b'[DONE]':
+                    self.response.read()
+                    completed = True
+                    break
+                yield json.loads(event.decode('utf-8'))
+        finally:
+            if completed:
+                self.client._finish(self.conn, self.response)
+            else:
+                self.conn.close()
+
+upstream = UpstreamClient(UPSTREAM_BASE_URL)
+metrics.gauge('anvil_scheduler_waiting', lambda: upstream.scheduler.stats()['waiting'],
+              'Upstream calls queued behind rate limits')
+metrics.gauge('anvil_upstream_idle_connections', lambda: upstream._idle.qsize(),
+              'Keep-alive upstream connections idle in the pool')
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one execution.
+
+    The first caller runs ``fn``; callers arriving while it is in flight
+    wait and receive the same result. If the leader fails, each waiter runs
+    ``fn`` itself, so one caller's bad API key or transient error is never
+    handed to someone else. Counters are kept per label."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.failed = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {}
+
+    def _count(self, label, name):
+        counters = self._counters.setdefault(label, {'executed': 0, 'shared': 0, 'retried_after_failure': 0})
+        counters[name] += 1
+        if name != 'shared':
+            # Shared calls are counted once they actually receive the leader's result
+            metrics.inc('anvil_coalesced_requests_total', {'endpoint': label, 'outcome': name},
+                        help_text='Coalescable upstream calls by outcome (shared ones saved an upstream call)')
+
+    def do(self, label, key, fn):
+        """Returns ``(result, shared)``."""
+        call_key = (label, key)
+        with self._lock:
+            call = self._calls.get(call_key)
+            leader = call is None
+            if leader:
+                call = self._calls[call_key] = self._Call()
+            self._count(label, 'executed' if leader else 'shared')
+
+        if leader:
+            try:
+                call.result = fn()
+                return call.result, False
+            except BaseException:
+                call.failed = True
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[call_key]
+                call.done.set()
+
+        call.done.wait()
+        if call.failed:
+            with self._lock:
+                self._counters[label]['shared'] -= 1
+                self._count(label, 'retried_after_failure')
+            return fn(), False
+        metrics.inc('anvil_coalesced_requests_total', {'endpoint': label, 'outcome': 'shared'})
+        return call.result, True
+
+    def stats(self):
+        with self._lock:
+            stats = {label: dict(counters) for label, counters in self._counters.items()}
+            in_flight = len(self._calls)
+        for counters in stats.values():
+            counters['upstream_calls_saved'] = counters['shared']
+        return {'in_flight': in_flight, 'endpoints': stats}
+
+
+coalescer = SingleFlight()
+metrics.gauge('anvil_coalesce_in_flight', lambda: coalescer.stats()['in_flight'],
+              'Distinct coalescable upstream calls currently in flight')
+
+
+class ResponseCache:
+    """Content-addressed cache for upstream completions.
+
+    Entries live in an in-memory LRU and are mirrored to one JSON file per
+    key under ``directory`` so they survive restarts. Both tiers expire
+    entries after ``ttl_seconds``; the disk tier is trimmed oldest-first
+    once it grows past ``max_disk_bytes``."""
+
+    def __init__(self, directory, max_memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES,
+                 max_disk_bytes=RESPONSE_CACHE_DISK_MAX_BYTES, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS):
+        self.directory = Path(directory)
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(payload):
+        canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.directory / f'{key}.json'
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created < self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if now - stored['created'] >= self.ttl_seconds:
+            self._remove_file(path)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self._remember(key, stored['created'], stored['value'])
+            self.hits += 1
+        return stored['value']
+
+    def put(self, key, value):
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, value)
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            data = json.dumps({'created': created, 'value': value}).encode('utf-8')
+            tmp_path = self._path(key).with_suffix(f'.{threading.get_ident()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            log.warning('response_cache_write_failed', error=str(e))
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(p.stat().st_size for p in self.directory.glob('*.json'))
+            else:
+                self._disk_bytes += len(data)
+            over_budget = self._disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self._trim_disk()
+
+    def _remember(self, key, created, value):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _remove_file(self, path):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+    def _trim_disk(self):
+        files = []
+        for path in self.directory.glob('*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        now = time.time()
+        total = sum(size for _, size, _ in files)
+        # Keep trimming until we are comfortably under budget so we don't rescan on every put
+        target = self.max_disk_bytes * 0.9
+        for mtime, size, path in files:
+            if total <= target and now - mtime < self.ttl_seconds:
+                continue
+            self._remove_file(path)
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+                'disk_bytes': self._disk_bytes,
+            }
+
+
+batch_cache = ResponseCache(RESPONSE_CACHE_DIR)
+metrics.gauge('anvil_response_cache_lookups', lambda: {
+    (('result', 'hit'),): batch_cache.hits,
+    (('result', 'miss'),): batch_cache.misses,
+}, 'Response cache lookups since startup')
+metrics.gauge('anvil_response_cache_memory_entries', lambda: len(batch_cache._memory),
+              'Entries held in the in-memory response cache tier')
+
+
+class NearDuplicateIndex:
+    """MinHash/LSH index of table entries for near-duplicate lookups.
+
+    Entries are reduced to character shingles (articles dropped), signed with
+    MINHASH_PERMUTATIONS xor-masked hashes and bucketed by LSH band, so a lookup only compares the
+    handful of entries that share a band instead of scanning the corpus.
+    Candidates are confirmed with the exact shingle Jaccard similarity."""
+
+    # 30-bit hashes and masks stay single-digit Python ints, which keeps xor/min cheap
+    _MASKS = [int.from_bytes(hashlib.blake2b(str(i).encode(), digest_size=4).digest(), 'big') & 0x3FFFFFFF
+              for i in range(MINHASH_PERMUTATIONS)]
+    _STOPWORDS = {'a', 'an', 'the'}
+
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD, bands=LSH_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = MINHASH_PERMUTATIONS // bands
+        self._lock = threading.Lock()
+        self._entries = {}        # id -> (text, shingles, source)
+        self._buckets = {}        # (band, band signature) -> set of ids
+        self._signatures = {}     # id -> band keys, for removal
+        self._by_source = {}      # source -> ids in insertion order (dict keys)
+        self._next_id = 0
+
+    @staticmethod
+    def shingles(text):
+        words = [w for w in re.sub(r'[^a-z0-9 ]+', ' ', normalize_entry(text)).split()
+                 if w not in NearDuplicateIndex._STOPWORDS]
+        joined = ' '.join(words)
+        if len(joined) <= SHINGLE_SIZE:
+            return frozenset([joined]) if joined else frozenset()
+        return frozenset(joined[i:i + SHINGLE_SIZE] for i in range(len(joined) - SHINGLE_SIZE + 1))
+
+    def _band_keys(self, shingles):
+        # str hashes are only compared within this process, so the seeded builtin hash will do
+        hashes = [hash(s) & 0x3FFFFFFF for s in shingles]
+        signature = [min(map(mask.__xor__, hashes)) for mask in self._MASKS]
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def add(self, text, source=None, limit=None):
+        """Index ``text`` under ``source``; with ``limit`` the source's
+        oldest entries are evicted beyond that many."""
+        shingles = self.shingles(text)
+        if not shingles:
+            return
+        keys = self._band_keys(shingles)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (text, shingles, source)
+            self._signatures[entry_id] = keys
+            ids = self._by_source.setdefault(source, {})
+            ids[entry_id] = None
+            for key in keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while limit is not None and len(ids) > limit:
+                oldest = next(iter(ids))
+                del ids[oldest]
+                self._discard(oldest)
+
+    def _discard(self, entry_id):
+        self._entries.pop(entry_id, None)
+        for key in self._signatures.pop(entry_id, ()):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def remove_source(self, source):
+        with self._lock:
+            for entry_id in self._by_source.pop(source, ()):
+                self._discard(entry_id)
+
+    def find(self, text, exclude=()):
+        """Most similar indexed entry at or above the threshold, as
+        ``{'text', 'source', 'similarity'}``, or None. Entries from sources
+        in ``exclude`` are ignored."""
+        shingles = self.shingles(text)
+        if not shingles:
+            return None
+        keys = self._band_keys(shingles)
+        best = None
+        with self._lock:
+            candidates = set()
+            for key in keys:
+                candidates.update(self._buckets.get(key, ()))
+            for entry_id in candidates:
+                other_text, other, source = self._entries[entry_id]
+                if source in exclude:
+                    continue
+                similarity = len(shingles & other) / len(shingles | other)
+                if similarity >= self.threshold and (best is None or similarity > best['similarity']):
+                    best = {'text': other_text, 'source': source, 'similarity': round(similarity, 3)}
+        return best
+
+    def index_file(self, path, source=None):
+        """(Re)index every non-macro result of a tables JSON file."""
+        source = source or str(path)
+        with open(path, encoding='utf-8') as f:
+            tables = json.load(f)
+        if isinstance(tables, dict):
+            tables = tables.get('tables', [])
+        self.remove_source(source)
+        count = 0
+        for table in tables:
+            for row in table.get('tableData', []):
+                result = row.get('result')
+                if isinstance(result, str) and result.strip() and not is_macro(result):
+                    self.add(result, source)
+                    count += 1
+        return count
+
+    def load_directory(self, directory):
+        total = 0
+        for path in sorted(Path(directory).glob('**/*.json')):
+            try:
+                total += self.index_file(path, str(path.relative_to(directory)))
+            except (OSError, ValueError, AttributeError) as e:
+                log.warning('corpus_index_failed', path=str(path), error=str(e))
+        return total
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'sources': len(self._by_source),
+                'buckets': len(self._buckets),
+                'threshold': self.threshold,
+            }
+
+
+corpus_index = NearDuplicateIndex()
+
+
+def load_corpus_index(directory=CORPUS_DIR):
+    start = time.perf_counter()
+    count = corpus_index.load_directory(directory)
+    log.info('corpus_index_loaded', directory=str(directory), entries=count,
+             seconds=round(time.perf_counter() - start, 2))
+metrics.gauge('anvil_corpus_index_entries', lambda: len(corpus_index), 'Table entries in the near-duplicate index')
+
+
+class EntryFilter:
+    """Accepts generated entries that are neither exact nor near duplicates
+    of the corpus, the caller's avoid list or entries accepted earlier in the
+    same request. Accepted entries are added to the corpus index as
+    ``generated`` so other tables and later requests avoid them too."""
+
+    GENERATED_SOURCE = 'generated'
+
+    def __init__(self, avoid_entries=(), corpus=None):
+        self.corpus = corpus_index if corpus is None else corpus
+        self.local = NearDuplicateIndex(self.corpus.threshold)
+        self.seen = set()
+        self.near_duplicates = []
+        for entry in avoid_entries or ():
+            if isinstance(entry, str):
+                self.seen.add(normalize_entry(entry))
+                self.local.add(entry, 'avoid')
+
+    def accept(self, entry, replay=False):
+        """``replay`` marks entries from a cached or coalesced completion.
+        Its first caller indexes them as generated, so replays are neither
+        checked against nor added to the generated entries - whichever
+        caller gets here first, they would only match themselves."""
+        if not isinstance(entry, str):
+            key = json.dumps(entry)
+            if key in self.seen:
+                return False
+            self.seen.add(key)
+            return True
+        key = normalize_entry(entry)
+        if not key or key in self.seen:
+            return False
+        exclude = (self.GENERATED_SOURCE,) if replay else ()
+        match = self.local.find(entry) or self.corpus.find(entry, exclude)
+        if match is not None:
+            self.near_duplicates.append({'result': entry, 'matches': match['text'],
+                                         'source': match['source'], 'similarity': match['similarity']})
+            against = match['source'] if match['source'] in ('avoid', 'accepted', self.GENERATED_SOURCE) else 'corpus'
+            metrics.inc('anvil_near_duplicates_dropped_total', {'against': against},
+                        help_text='Generated entries dropped as near duplicates')
+            return False
+        self.seen.add(key)
+        self.local.add(entry, 'accepted')
+        if not replay:
+            self.corpus.add(entry, self.GENERATED_SOURCE, limit=GENERATED_INDEX_MAX_ENTRIES)
+        return True
+
+    def avoid_list(self):
+        """Corpus entries the model came too close to, for the top-up prompt."""
+        return [dup['matches'] for dup in self.near_duplicates]
+
+
+# Genre-specific styles
+GENRE_STYLES = {
+    'dark-fantasy': {
+        'tone': 'Grim, morally complex, visceral',
+        'inspiration': 'Joe Abercrombie style - harsh realism, flawed characters, bitter consequences'
+    },
+    'fantasy': {
+        'tone': 'Epic, heroic, wonder-filled',
+        'inspiration': 'Margaret Weis & Tracy Hickman style - grand quests, noble heroes, magical wonder'
+    },
+    'sci-fi': {
+        'tone': 'Technological, political, realistic', 
+        'inspiration': 'James S.A. Corey style - hard science, political intrigue, human struggle'
+    },
+    'starforged': {
+        'tone': 'Swashbuckling, maritime adventure, mystical',
+        'inspiration': 'R.A. Salvatore style - heroic adventure, nautical themes, ancient mysteries'
+    }
+}
+
+# Table type rules with contextual generation
+TABLE_RULES = {
+    'objective': {
+        'word_count': '6-10 words',
+        'focus': 'Thematic obstacles, challenges, puzzles, goals, or tasks that need to be accomplished',
+        'style': 'Clear objectives that players must overcome or achieve to succeed or prevent negative outcomes'
+    },
+    'atmosphere': {
+        'word_count': '4-10 words', 
+        'focus': 'Sensory experiences, emotional feelings, or intuitive impressions that set the mood',
+        'style': 'Evocative phrases capturing any sense (sight, sound, smell, touch, taste) or emotional/intuitive feelings'
+    },
+    'manifestation': {
+        'word_count': '4-10 words',
+        'focus': 'Tangible expressions of abstract themes that players can interact with',
+        'style': 'Physical, observable phenomena that bring thematic elements to life'
+    },
+    'location': {
+        'word_count': '4-10 words',
+        'focus': 'Context-appropriate locations: For buildings/structures, generate ROOMS (throne room, dungeon cell, armory). For natural/exploration domains, generate AREAS or FEATURES (hidden grove, ancient cairn, frozen lake). Consider what explorers would encounter.',
+        'style': 'Buildings: interior rooms and chambers. Wilderness: geographical features, landmarks, and exploration sites. Settlements: districts, buildings, gathering places.'
+    },
+    'discovery': {
+        'word_count': '4-10 words',
+        'focus': 'Context-specific discoveries fitting the domain/aspect: Ancient places yield historical artifacts, forgotten knowledge, relics. Natural areas contain rare materials, hidden paths, wildlife signs. Structures hold secret passages, hidden chambers, forgotten items. Mystical domains reveal magical phenomena, enchanted objects. Match discoveries to what would realistically be found in this specific environment.',
+        'style': 'Treasures, secrets, lore, clues, artifacts, or phenomena that reward exploration and deepen understanding of this particular place or theme'
+    },
+    'bane': {
+        'word_count': '4-10 words',
+        'focus': 'Negative influences or obstacles that create challenges',
+        'style': 'Threatening elements that add tension and conflict to scenes'
+    },
+    'boon': {
+        'word_count': '4-10 words',
+        'focus': 'Positive influences or advantages that aid characters',
+        'style': 'Beneficial elements that provide assistance or opportunities'
+    }
+}
+
+
+class JSONArrayStreamParser:
+    """Incrementally pulls string elements out of a JSON array as text arrives.
+
+    Anything before the opening ``[`` (such as a ```json fence) is skipped,
+    brackets and escaped quotes inside strings are handled, and parsing stops
+    at the closing ``]``. Non-string elements are skipped."""
+
+    def __init__(self):
+        self.started = False
+        self.finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._buffer = []
+
+    def feed(self, text):
+        entries = []
+        for ch in text:
+            if self.finished:
+                break
+            if not self.started:
+                if ch == '[':
+                    self.started = True
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        raw = ''.join(self._buffer)
+                        self._buffer = []
+                        try:
+                            entries.append(json.loads(f'"{raw}"'))
+                        except json.JSONDecodeError:
+                            entries.append(raw)
+                    continue
+                if self._depth == 1:
+                    self._buffer.append(ch)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in '[{':
+                self._depth += 1
+            elif ch in ']}':
+                self._depth -= 1
+                if self._depth == 0:
+                    self.finished = True
+        return entries
+
+
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for budgeting English prompts
+    return len(text) // 4 + 1
+
+
+def completion_tokens_per_entry(table_type):
+    rules = TABLE_RULES.get(table_type, TABLE_RULES['atmosphere'])
+    max_words = int(re.findall(r'\d+', rules['word_count'])[-1])
+    return max_words * TOKENS_PER_WORD + ENTRY_OVERHEAD_TOKENS
+
+
+def estimate_completion_tokens(table_type, num_entries):
+    raw = ARRAY_OVERHEAD_TOKENS + num_entries * completion_tokens_per_entry(table_type)
+    return int(raw * COMPLETION_SAFETY_MARGIN) + 1
+
+
+def estimate_prompt_tokens(openai_request):
+    # Each chat message carries a few tokens of framing on top of its content.
+    # Proxied requests may omit messages or send structured (non-string) content.
+    return sum(estimate_tokens(str(m.get('content') or '')) + 4 for m in openai_request.get('messages') or [])
+
+
+def plan_batch_parts(data):
+    """Split ``num_entries`` into sub-batch sizes that each fit the request budget."""
+    openai_request, params = build_batch_request(data)
+    num_entries = params['num_entries']
+    room = MAX_REQUEST_TOKENS - estimate_prompt_tokens(openai_request) - ARRAY_OVERHEAD_TOKENS
+    per_entry = completion_tokens_per_entry(params['table_type']) * COMPLETION_SAFETY_MARGIN
+    per_part = max(1, min(MAX_ENTRIES_PER_REQUEST, int(room // per_entry)))
+    parts = max(1, -(-num_entries // per_part))
+    base, extra = divmod(num_entries, parts)
+    return [base + (1 if i < extra else 0) for i in range(parts)]
+
+
+def build_batch_request(data):
+    """Render the batch generation prompt for a /api/batch-generate body.
+
+    Returns the OpenAI request payload together with the request parameters
+    the response parser and logging need."""
+    table_type = data.get('table_type')
+    model = data.get('model', 'gpt-3.5-turbo')
+    domain_context = data.get('domain_context')
+    num_entries = data.get('num_entries', 10)
+    genre = data.get('genre', 'dark-fantasy')
+
+    # Build context for batch generation
+    context_name = domain_context.get('name', 'Unknown') if domain_context else 'Unknown'
+    context_type = domain_context.get('type', 'concept') if domain_context else 'concept'
+    context_description = domain_context.get('description', '') if domain_context else ''
+
+    current_genre = GENRE_STYLES.get(genre, GENRE_STYLES['dark-fantasy'])
+    current_rules = TABLE_RULES.get(table_type, TABLE_RULES['atmosphere'])
+
+    # Build context information
+    context_info = f"""
+🎯 PRIMARY THEME: This is the {context_type.upper()} '{context_name}' - the CORE CONCEPT that defines everything.
+DESCRIPTION: {context_description}
+
+CRITICAL: Every single piece of content must directly derive from and embody the essence of '{context_name}'. This {context_type} is the foundational theme that gives meaning to all elements.
+
+The {context_type} name '{context_name}' is not just flavor text - it is the generative source of all content."""
+
+    # Create system prompt
+    system_prompt = f"""You are a creative writing assistant specializing in tabletop RPG content generation. You create evocative, thematic content for ForgeTable random tables.
+
+WRITING REQUIREMENTS:
+- Target 9th grade reading level while maintaining creativity and style
+- Write in {current_genre['tone']} style
+- Inspired by {current_genre['inspiration']}
+- Each entry should be {current_rules['word_count']} words
+- Focus: {current_rules['focus']}
+- Style: {current_rules['style']}
+
+{context_info}
+
+ANTI-REPETITION RULES:
+- Never repeat the same opening words across entries
+- Vary sentence structure and phrasing dramatically
+- Avoid formulaic patterns or templates
+- Each entry must feel unique and distinct
+
+Generate EXACTLY {num_entries} creative entries that embody the essence of '{context_name}'. 
+
+CRITICAL: Return ONLY a valid JSON array of strings, nothing else. No explanations, no markdown, no additional text - just the JSON array.
+
+Example format: ["Entry 1", "Entry 2", "Entry 3"]"""
+
+    user_prompt = f"Generate {num_entries} {table_type} entries for the {context_type} '{context_name}'."
+    part = data.get('part')
+    if part:
+        user_prompt += f" This is part {part[0]} of {part[1]} of one table; other parts are written separately, so take this part in its own direction."
+    avoid_entries = data.get('avoid_entries')
+    if avoid_entries:
+        user_prompt += ("\n\nThe table already contains these entries. Do not repeat or closely paraphrase any of them:\n"
+                        + json.dumps(avoid_entries, ensure_ascii=False))
+
+    # Create OpenAI request with model-specific parameters
+    openai_request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+    }
+    
+    # Add model-specific parameters, sized to the number of entries requested
+    completion_budget = estimate_completion_tokens(table_type, num_entries)
+    if model == "gpt-5":
+        # GPT-5 uses max_completion_tokens, reasoning_effort, and default temperature (1)
+        # Reasoning tokens count against the budget, so leave room for them on top of the content
+        openai_request["max_completion_tokens"] = completion_budget + REASONING_ALLOWANCE_TOKENS
+        openai_request["reasoning_effort"] = "minimal"
+        # Temperature defaults to 1 for GPT-5, don't set it
+    else:
+        # All other models use max_tokens and can set temperature
+        openai_request["max_tokens"] = completion_budget
+        openai_request["temperature"] = 0.9
+
+    params = {
+        'model': model,
+        'table_type': table_type,
+        'num_entries': num_entries,
+        'context_name': context_name,
+        'context_type': context_type,
+    }
+    return openai_request, params
+
+
+def count_parse_path(path):
+    metrics.inc('anvil_batch_parse_total', {'path': path},
+                help_text='Batch generation responses by the parse path that produced the results')
+
+
+def parse_batch_response(response_data, num_entries, status=200):
+    """Turn a chat completion into ``{'results': [...]}`` or ``{'error': ...}``."""
+    if 'error' in response_data:
+        error_details = response_data['error']
+        error_msg = f"OpenAI API error {status}: {error_details.get('message', 'Unknown error')}"
+        log.warning('batch_api_error', error=error_msg)
+        return {
+            'error': error_msg,
+            'details': error_details
+        }
+
+    if 'choices' in response_data and len(response_data['choices']) > 0:
+        choice = response_data['choices'][0]
+        content = choice['message']['content'].strip()
+        finish_reason = choice.get('finish_reason', 'unknown')
+
+        log.debug('batch_completion', finish_reason=finish_reason, chars=len(content))
+
+        # Check if we got an empty response due to token limits
+        if not content and finish_reason == 'length':
+            log.warning('batch_reasoning_exhausted', usage=response_data.get('usage', {}))
+            return {
+                'error': 'GPT-5 used all tokens for reasoning. Try reducing reasoning_effort or increasing max_completion_tokens.',
+                'details': {'finish_reason': finish_reason, 'usage': response_data.get('usage', {})}
+            }
+
+        # Clean up the content for JSON parsing
+        cleaned_content = content
+        if cleaned_content.startswith('```json'):
+            cleaned_content = cleaned_content[7:]
+        if cleaned_content.startswith('```'):
+            cleaned_content = cleaned_content[3:]
+        if cleaned_content.endswith('```'):
+            cleaned_content = cleaned_content[:-3]
+        cleaned_content = cleaned_content.strip()
+
+        if finish_reason == 'length':
+            # Truncated mid-array: keep every entry that was completed
+            results = JSONArrayStreamParser().feed(cleaned_content)[:num_entries]
+            if results:
+                log.info('batch_truncated_salvage', results=len(results), requested=num_entries)
+                count_parse_path('truncated_salvage')
+                return {'results': results}
+
+        try:
+            # Parse JSON response using cleaned content
+            results = json.loads(cleaned_content)
+            if isinstance(results, list):
+                # Truncate to requested number if AI returned more
+                results = results[:num_entries]
+                count_parse_path('direct_json')
+                return {'results': results}
+            else:
+                raise ValueError("Expected array response")
+        except (json.JSONDecodeError, ValueError) as e:
+            log.info('batch_json_parse_failed', error=str(e), chars=len(cleaned_content))
+            log.payload('batch_json_parse_failed_content', content=cleaned_content)
+
+            # Try to extract JSON array from the response
+            json_match = re.search(r'\[.*?\]', cleaned_content, re.DOTALL)
+            if json_match:
+                try:
+                    extracted_json = json_match.group(0)
+                    results = json.loads(extracted_json)
+                    if isinstance(results, list):
+                        results = results[:num_entries]
+                        count_parse_path('regex_extraction')
+                        return {'results': results}
+                except json.JSONDecodeError:
+                    log.debug('batch_extracted_json_failed')
+
+            # Final fallback: split by lines and clean up
+            lines = [line.strip().strip('"-,').strip() for line in cleaned_content.split('\n') if line.strip()]
+            results = [line for line in lines if line and not line.startswith('[') and not line.startswith(']') and not line.startswith('{')][:num_entries]
+            log.info('batch_line_split_fallback', results=len(results))
+            if results:
+                count_parse_path('line_split')
+                return {'results': results}
+            else:
+                count_parse_path('failed')
+                return {'error': f'Could not parse AI response: {cleaned_content[:500]}...'}
+    else:
+        log.warning('batch_no_choices', response=response_data)
+        return {'error': 'No response from OpenAI'}
+
+
+def describe_upstream_error(e):
+    error_body = e.body.decode('utf-8') if e.body else 'No error details'
+    try:
+        error_json = json.loads(error_body)
+        log.warning('upstream_error', status=e.code, details=error_json)
+        return {
+            'error': f'OpenAI API error: {e.code}',
+            'details': error_json
+        }
+    except json.JSONDecodeError:
+        log.warning('upstream_error', status=e.code, details=error_body)
+        return {
+            'error': f'OpenAI API error: {e.code}',
+            'details': {'message': error_body}
+        }
+
+
+def run_batch_generation(data, api_key, use_cache=True, coalesce=True, priority=PRIORITY_STANDARD):
+    """Generate entries for one table. Returns ``(result, cache_status)``
+    where ``cache_status`` is HIT, MISS, BYPASS or PARTIAL.
+
+    Requests too large for one call are split into parallel sub-batches. The
+    merged results are de-duplicated - exactly and, through the corpus
+    index, approximately - and any shortfall is topped up with follow-up
+    requests for just the missing count that list the entries to avoid."""
+    num_entries = data.get('num_entries', 10)
+    sizes = plan_batch_parts(data)
+    if len(sizes) == 1:
+        parts = [generate_batch_part(data, api_key, use_cache, coalesce, priority)]
+    else:
+        log.info('batch_split', num_entries=num_entries, parts=sizes)
+        part_requests = [dict(data, num_entries=size, part=[i + 1, len(sizes)]) for i, size in enumerate(sizes)]
+        with ThreadPoolExecutor(max_workers=min(BATCH_SPLIT_CONCURRENCY, len(sizes)),
+                                thread_name_prefix='anvil-split') as pool:
+            parts = list(pool.map(lambda request: generate_batch_part(request, api_key, use_cache, coalesce, priority),
+                                  part_requests))
+
+    results = []
+    errors = []
+    statuses = set()
+    succeeded = 0
+    entry_filter = EntryFilter(data.get('avoid_entries'))
+
+    def merge(result, cache_status, shared):
+        nonlocal succeeded
+        statuses.add(cache_status)
+        if 'error' in result:
+            errors.append(result)
+            return
+        succeeded += 1
+        for entry in result['results']:
+            # A cached or shared completion is indexed by its first caller only
+            if entry_filter.accept(entry, replay=shared or cache_status == 'HIT'):
+                results.append(entry)
+
+    for part in parts:
+        merge(*part)
+
+    for _ in range(BATCH_TOPUP_ROUNDS):
+        missing = num_entries - len(results)
+        # Still top up when every entry was dropped as a near duplicate; only give up if every call failed
+        if missing <= 0 or not succeeded:
+            break
+        log.info('batch_topup', missing=missing, near_duplicates=len(entry_filter.near_duplicates))
+        avoid_entries = list(data.get('avoid_entries') or []) + results + entry_filter.avoid_list()
+        topup = dict(data, num_entries=missing, avoid_entries=avoid_entries)
+        topup.pop('part', None)
+        merge(*generate_batch_part(topup, api_key, use_cache, coalesce, priority))
+
+    cache_status = statuses.pop() if len(statuses) == 1 else 'PARTIAL'
+    if not results and errors:
+        return errors[0], cache_status
+    response = {'results': results[:num_entries]}
+    if entry_filter.near_duplicates:
+        response['near_duplicates_dropped'] = entry_filter.near_duplicates
+        if not results:
+            response['error'] = 'Every generated entry was a near duplicate of an existing table entry'
+    if errors:
+        response['errors'] = [error['error'] for error in errors]
+    return response, cache_status
+
+
+def generate_batch_part(data, api_key, use_cache=True, coalesce=True, priority=PRIORITY_STANDARD):
+    """Make (or replay from cache) a single batch generation request.
+    Returns ``(result, cache_status, shared)``.
+
+    With ``coalesce`` an identical request already in flight is joined
+    instead of calling upstream again; ``shared`` says this caller joined."""
+    openai_request, params = build_batch_request(data)
+
+    log.info('batch_request', model=params['model'], table_type=params['table_type'],
+             num_entries=params['num_entries'], context=params['context_name'], context_type=params['context_type'])
+    log.payload('batch_request_payload', request=openai_request)
+
+    cache_key = ResponseCache.key_for(openai_request)
+    if use_cache:
+        cached = batch_cache.get(cache_key)
+        if cached is not None:
+            log.debug('response_cache_hit', key=cache_key[:12])
+            return parse_batch_response(cached, params['num_entries']), 'HIT', False
+        cache_status = 'MISS'
+    else:
+        cache_status = 'BYPASS'
+
+    def call_upstream():
+        response = upstream.chat_completion(openai_request, api_key, priority)
+        return response.status, response.json()
+
+    try:
+        if coalesce:
+            (status, response_data), shared = coalescer.do('/api/batch-generate', cache_key, call_upstream)
+            if shared:
+                log.debug('coalesced', key=cache_key[:12])
+        else:
+            (status, response_data), shared = call_upstream(), False
+    except UpstreamHTTPError as e:
+        return describe_upstream_error(e), cache_status, False
+    if not shared:
+        record_usage(params['model'], params['table_type'], response_data.get('usage'))
+
+    log.payload('batch_response_payload', response=response_data)
+
+    result = parse_batch_response(response_data, params['num_entries'], status)
+    # Only keep responses that parsed, so a retry after a bad completion asks again
+    if 'results' in result:
+        batch_cache.put(cache_key, response_data)
+    return result, cache_status, shared
+
+
+def stream_batch_generation(data, api_key, emit, use_cache=True, priority=PRIORITY_STANDARD):
+    """Streaming variant of run_batch_generation.
+
+    Calls ``emit(event, payload)`` with an ``entry`` event for every result
+    as soon as it is parsed, then a final ``done`` event carrying all
+    results, usage and finish_reason (or a single ``error`` event). Near
+    duplicates are never emitted; any shortfall is topped up after the
+    stream ends, as in run_batch_generation."""
+    openai_request, params = build_batch_request(data)
+    num_entries = params['num_entries']
+    entry_filter = EntryFilter(data.get('avoid_entries'))
+    results = []
+
+    def accept(entries, replay=False):
+        for entry in entries:
+            if len(results) < num_entries and entry_filter.accept(entry, replay):
+                emit('entry', {'index': len(results), 'result': entry})
+                results.append(entry)
+
+    def finish(usage, finish_reason, cache_status):
+        for _ in range(BATCH_TOPUP_ROUNDS):
+            missing = num_entries - len(results)
+            if missing <= 0:
+                break
+            log.info('batch_topup', missing=missing, near_duplicates=len(entry_filter.near_duplicates), stream=True)
+            avoid_entries = list(data.get('avoid_entries') or []) + results + entry_filter.avoid_list()
+            topup = dict(data, num_entries=missing, avoid_entries=avoid_entries)
+            topup.pop('part', None)
+            result, topup_status, shared = generate_batch_part(topup, api_key, use_cache, priority=priority)
+            if 'error' in result:
+                break
+            accept(result['results'], replay=shared or topup_status == 'HIT')
+        done = {
+            'results': results,
+            'usage': usage,
+            'finish_reason': finish_reason,
+            'cache': cache_status,
+        }
+        if entry_filter.near_duplicates:
+            done['near_duplicates_dropped'] = entry_filter.near_duplicates
+        emit('done', done)
+
+    log.info('batch_request', model=params['model'], table_type=params['table_type'], num_entries=num_entries,
+             context=params['context_name'], context_type=params['context_type'], stream=True)
+    log.payload('batch_request_payload', request=openai_request)
+
+    cache_key = ResponseCache.key_for(openai_request)
+    if use_cache:
+        cached = batch_cache.get(cache_key)
+        if cached is not None:
+            log.debug('response_cache_hit', key=cache_key[:12])
+            result = parse_batch_response(cached, num_entries)
+            if 'error' in result:
+                emit('error', result)
+                return
+            accept(result['results'], replay=True)
+            finish(cached.get('usage', {}), cached['choices'][0].get('finish_reason', 'unknown'), 'HIT')
+            return
+        cache_status = 'MISS'
+    else:
+        cache_status = 'BYPASS'
+
+    stream_request = dict(openai_request, stream=True, stream_options={'include_usage': True})
+    parser = JSONArrayStreamParser()
+    parsed_any = False
+    content_parts = []
+    usage = {}
+    finish_reason = 'unknown'
+    try:
+        for chunk in upstream.stream_chat_completion(stream_request, api_key, priority):
+            if chunk.get('error'):
+                emit('error', {'error': f"OpenAI API error: {chunk['error'].get('message', 'Unknown error')}",
+                               'details': chunk['error']})
+                return
+            if chunk.get('usage'):
+                usage = chunk['usage']
+            for choice in chunk.get('choices') or []:
+                if choice.get('finish_reason'):
+                    finish_reason = choice['finish_reason']
+                delta = (choice.get('delta') or {}).get('content')
+                if not delta:
+                    continue
+                content_parts.append(delta)
+                entries = parser.feed(delta)
+                parsed_any = parsed_any or bool(entries)
+                accept(entries)
+    except UpstreamHTTPError as e:
+        emit('error', describe_upstream_error(e))
+        return
+
+    record_usage(params['model'], params['table_type'], usage)
+    content = ''.join(content_parts)
+    log.payload('batch_response_payload', content=content, finish_reason=finish_reason, usage=usage)
+
+    # Reassemble a regular completion so the cache and fallback parser can reuse it
+    response_data = {
+        'choices': [{'message': {'role': 'assistant', 'content': content}, 'finish_reason': finish_reason}],
+        'usage': usage,
+    }
+    if not parsed_any:
+        # The model didn't produce a JSON array; fall back to the regular parser
+        result = parse_batch_response(response_data, num_entries)
+        if 'error' in result:
+            emit('error', result)
+            return
+        accept(result['results'])
+
+    batch_cache.put(cache_key, response_data)
+    finish(usage, finish_reason, cache_status)
+
+
+# Keyword -> table_type, mirroring tableTypeFromName() in index.html
+TABLE_TYPE_KEYWORDS = [
+    ('objective', 'objective'),
+    ('manifestation', 'manifestation'),
+    ('location', 'location'),
+    ('discover', 'discovery'),
+    ('bane', 'bane'),
+    ('boon', 'boon'),
+    ('atmosphere', 'atmosphere'),
+]
+
+
+def table_type_from_name(name_or_type):
+    name = (name_or_type or '').lower()
+    for keyword, table_type in TABLE_TYPE_KEYWORDS:
+        if keyword in name:
+            return table_type
+    return 'atmosphere'
+
+
+FORGE_FILE_FIELDS = ('category', 'name', 'description', 'tables')
+
+
+def plan_file_generation(data):
+    """Split a generate-file request into ``(document, steps)``.
+
+    ``data`` is either the payload itself (``{category, name, description,
+    tables}``) or ``{"document": payload, ...}``; ``model`` and ``genre`` may
+    be given alongside. Each step is ``(table, empty_rows, request)`` for a
+    table with rows whose result is ``""``, so macro rows stay as they are.
+    Planning is deterministic, which lets jobs re-plan and replay
+    checkpointed steps."""
+    if 'document' in data:
+        document = copy.deepcopy(data['document'])
+    else:
+        # Only the ForgeFilePayload fields; request options must not leak into the saved file
+        document = {key: copy.deepcopy(data[key]) for key in FORGE_FILE_FIELDS if key in data}
+    tables = document['tables'] if isinstance(document, dict) else document
+    if isinstance(document, dict):
+        context = {
+            'type': (document.get('category') or 'concept').lower(),
+            'name': document.get('name') or data.get('name'),
+            'description': document.get('description') or data.get('description', ''),
+        }
+    else:
+        context = {
+            'type': (data.get('category') or (tables[0].get('category') if tables else None) or 'concept').lower(),
+            'name': data.get('name'),
+            'description': data.get('description', ''),
+        }
+
+    steps = []
+    for table in tables:
+        empty_rows = [row for row in table.get('tableData', []) if row.get('result') == '']
+        if not empty_rows:
+            continue
+        request = {
+            'table_type': table_type_from_name(table.get('name') or table.get('oracle_type')),
+            'table_name': table.get('name'),
+            'model': data.get('model', 'gpt-3.5-turbo'),
+            'genre': data.get('genre', 'dark-fantasy'),
+            'domain_context': context,
+            'num_entries': len(empty_rows),
+        }
+        steps.append((table, empty_rows, request))
+    return document, steps
+
+
+def fill_file_table(step, result, cache_status):
+    """Write a table's generated entries into its empty rows; returns the
+    per-table summary."""
+    table, empty_rows, request = step
+    entries = result.get('results', [])
+    for row, entry in zip(empty_rows, entries):
+        row['result'] = entry
+    table_summary = {
+        'name': table.get('name'),
+        'table_type': request['table_type'],
+        'requested': len(empty_rows),
+        'filled': min(len(empty_rows), len(entries)),
+        'cache': cache_status,
+    }
+    if 'error' in result:
+        table_summary['error'] = result['error']
+    return table_summary
+
+
+def generate_file(data, api_key, use_cache=True, max_concurrency=FANOUT_CONCURRENCY, coalesce=True,
+                  priority=PRIORITY_BULK):
+    """Fill every empty row of a ForgeFilePayload document (see
+    plan_file_generation). Tables are generated in parallel."""
+    document, steps = plan_file_generation(data)
+
+    summary = []
+    if steps:
+        workers = max(1, min(max_concurrency, len(steps)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='anvil-fanout') as pool:
+            futures = [pool.submit(run_batch_generation, request, api_key, use_cache, coalesce, priority)
+                       for _, _, request in steps]
+            for step, future in zip(steps, futures):
+                try:
+                    result, cache_status = future.result()
+                except Exception as e:
+                    result, cache_status = {'error': f'Batch generation failed: {str(e)}'}, None
+                summary.append(fill_file_table(step, result, cache_status))
+
+    return {'document': document, 'tables': summary}
+
+
+# Macro rows are table mechanics rather than content; mirrors macroPatterns in index.html
+MACRO_PATTERN = re.compile(
+    r'^\s*(the weave|connection web|roll twice|action \+ theme|descriptor \+ focus|objectives)\s*$',
+    re.IGNORECASE,
+)
+
+
+def is_macro(text):
+    return bool(MACRO_PATTERN.match(text or ''))
+
+
+def normalize_entry(text):
+    return ' '.join((text or '').lower().split())
+
+
+def build_review_request(rows, table_type, table_name, model, domain_context):
+    context_line = ''
+    if domain_context and domain_context.get('name'):
+        context_line = f"\nThese entries belong to the {domain_context.get('type', 'concept')} '{domain_context['name']}'. {domain_context.get('description') or ''}\n"
+    system_prompt = f"""You are an AI assistant helping to review and improve fantasy tabletop RPG content. 
+
+Your task is to analyze text entries from ForgeTable data and decide if they need changes.
+
+Rules:
+- LEAVE: Keep content that is already good, unique, and fitting
+- MODIFY: Fix content that has issues (duplicates, poor word count, style issues)  
+- RECREATE: Replace content that is fundamentally flawed
+
+For {table_type} tables:
+- Style: Grim fantasy, concrete imagery, no modern references, no comedy
+- Word count: {TABLE_RULES.get(table_type, TABLE_RULES['atmosphere'])['word_count']}
+- Objectives should be scene-inspiring prompts in Joe Abercrombie style
+- Other tables avoid direct character interaction
+{context_line}
+You will receive a JSON array of entries, each with an "id" and "text". Review every entry.
+
+Respond with JSON only: {{"reviews": [{{"id": <id>, "decision": "LEAVE|MODIFY|RECREATE", "new_result": "replacement text if needed"}}]}}"""
+
+    user_prompt = f"Table: {table_name}\nEntries:\n" + json.dumps(
+        [{'id': row_id, 'text': text} for row_id, text in rows], ensure_ascii=False)
+
+    openai_request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+    }
+    completion_tokens = 60 + 40 * len(rows)
+    if model == "gpt-5":
+        openai_request["max_completion_tokens"] = completion_tokens + 500
+        openai_request["reasoning_effort"] = "minimal"
+    else:
+        openai_request["max_tokens"] = completion_tokens
+        openai_request["temperature"] = 0.7
+    return openai_request
+
+
+def parse_review_response(response_data):
+    content = response_data['choices'][0]['message']['content'].strip()
+    if content.startswith('```'):
+        content = content.split('\n', 1)[1] if '\n' in content else content[3:]
+    if content.endswith('```'):
+        content = content[:-3]
+    content = content.strip()
+    try:
+        parsed = json.loads(content)
+    except json.JSONDecodeError:
+        # Fall back to the outermost JSON object in the reply
+        start, end = content.find('{'), content.rfind('}')
+        if start == -1 or end <= start:
+            raise ValueError(f'Could not parse review response: {content[:200]}')
+        parsed = json.loads(content[start:end + 1])
+    reviews = parsed.get('reviews', []) if isinstance(parsed, dict) else parsed
+    by_id = {}
+    for review in reviews:
+        if not isinstance(review, dict):
+            continue
+        try:
+            by_id[int(review.get('id'))] = review
+        except (TypeError, ValueError):
+            continue
+    return by_id
+
+
+def chunk_review_rows(rows, token_budget=REVIEW_CHUNK_TOKEN_BUDGET, max_rows=REVIEW_MAX_ROWS):
+    chunks, current, current_tokens = [], [], 0
+    for row_id, text in rows:
+        # Per-row JSON overhead ({"id": .., "text": ..}) is roughly 10 tokens
+        cost = estimate_tokens(text) + 10
+        if current and (current_tokens + cost > token_budget or len(current) >= max_rows):
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append((row_id, text))
+        current_tokens += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def review_table(data, api_key, max_concurrency=REVIEW_CONCURRENCY, priority=PRIORITY_BULK):
+    """Review a whole table in as few upstream calls as possible.
+
+    Macro rows, empty rows and exact duplicates are decided locally; all
+    other rows are packed into token-budgeted chunks that are reviewed
+    concurrently. Returns one decision per row in table order, with
+    ``failed_chunks`` counting chunks that produced no decisions and an
+    ``error`` when none of them did."""
+    table = data['table']
+    table_type = data.get('table_type') or table_type_from_name(table.get('name') or table.get('oracle_type'))
+    model = data.get('model', 'gpt-3.5-turbo')
+    rows = table.get('tableData', [])
+
+    decisions = []
+    pending = []
+    first_seen = {}
+    for index, row in enumerate(rows):
+        text = row.get('result', '')
+        decision = {'floor': row.get('floor'), 'ceiling': row.get('ceiling'), 'original': text}
+        key = normalize_entry(text)
+        if not key:
+            decision.update(decision='LEAVE', new_result=text, source='empty')
+        elif is_macro(text):
+            decision.update(decision='LEAVE', new_result=text, source='macro')
+        elif key in first_seen:
+            duplicate_of = rows[first_seen[key]]
+            decision.update(decision='RECREATE', new_result=None, source='duplicate',
+                            reason=f"Duplicate of row {duplicate_of.get('floor')}-{duplicate_of.get('ceiling')}")
+        else:
+            first_seen[key] = index
+            pending.append((index, text))
+        decisions.append(decision)
+
+    chunks = chunk_review_rows(pending)
+    usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    chunk_errors = []
+
+    def review_chunk(chunk):
+        openai_request = build_review_request(chunk, table_type, table.get('name'), model, data.get('domain_context'))
+        response = upstream.chat_completion(openai_request, api_key, priority)
+        response_data = response.json()
+        record_usage(model, table_type, response_data.get('usage'))
+        return parse_review_response(response_data), response_data.get('usage', {})
+
+    if chunks:
+        workers = max(1, min(max_concurrency, len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='anvil-review') as pool:
+            futures = [pool.submit(review_chunk, chunk) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    reviews, chunk_usage = future.result()
+                    error = None
+                except UpstreamHTTPError as e:
+                    reviews, chunk_usage, error = {}, {}, describe_upstream_error(e)['error']
+                except Exception as e:
+                    reviews, chunk_usage, error = {}, {}, f'Review failed: {str(e)}'
+                for key in usage:
+                    usage[key] += chunk_usage.get(key, 0)
+                if error or not any(index in reviews for index, _ in chunk):
+                    chunk_errors.append(error or 'No decisions returned')
+                for index, text in chunk:
+                    decision = decisions[index]
+                    review = reviews.get(index)
+                    if review is None:
+                        decision.update(decision=None, new_result=None, source='model',
+                                        error=error or 'No decision returned for this row')
+                        continue
+                    verdict = str(review.get('decision', 'LEAVE')).upper()
+                    new_result = review.get('new_result') or text
+                    if verdict == 'LEAVE':
+                        new_result = text
+                    elif new_result != text:
+                        new_result = new_result[:1].upper() + new_result[1:]
+                    decision.update(decision=verdict, new_result=new_result, source='model')
+
+    counts = {}
+    for decision in decisions:
+        counts[decision['decision']] = counts.get(decision['decision'], 0) + 1
+    log.info('batch_review', table=table.get('name'), rows=len(rows), upstream_calls=len(chunks), decisions=counts,
+             failed_chunks=len(chunk_errors))
+    result = {
+        'decisions': decisions,
+        'upstream_calls': len(chunks),
+        'failed_chunks': len(chunk_errors),
+        'usage': usage,
+    }
+    if chunks and len(chunk_errors) == len(chunks):
+        result['error'] = f'All {len(chunks)} review chunks failed: {chunk_errors[0]}'
+    return result
+
+
+def table_ids(source, tables):
+    """``<source>/<table name>`` for each table, falling back to the table's
+    position when it has no name or shares one with an earlier table."""
+    ids, seen = [], set()
+    for position, table in enumerate(tables):
+        table_id = f"{source}/{table.get('name', position)}"
+        if table_id.lower() in seen:
+            table_id = f"{source}/{position}"
+            if table_id.lower() in seen:
+                table_id = f"{source}/{table.get('name')}/{position}"
+        seen.add(table_id.lower())
+        ids.append(table_id)
+    return ids
+
+
+class CompiledTable:
+    """A table compiled for rolling: ``lookup[roll - 1]`` is the index of the
+    row covering that roll (``len(rows)`` for rolls no row covers)."""
+
+    def __init__(self, table_id, source, table):
+        self.id = table_id
+        self.source = source
+        self.name = table.get('name', '')
+        self.rows = [row for row in table.get('tableData', []) if isinstance(row, dict)]
+        ceilings = [int(row.get('ceiling', 0)) for row in self.rows]
+        self.max_roll = int(table.get('maxRoll') or max(ceilings + [1]))
+        self.gap = len(self.rows)
+        self.warnings = []
+        lookup = [self.gap] * self.max_roll
+        for index, row in enumerate(self.rows):
+            floor, ceiling = int(row.get('floor', 0)), int(row.get('ceiling', 0))
+            for roll in range(max(floor, 1), min(ceiling, self.max_roll) + 1):
+                if lookup[roll - 1] != self.gap:
+                    self.warnings.append(f"roll {roll} is covered by more than one row")
+                    continue
+                lookup[roll - 1] = index
+        gaps = lookup.count(self.gap)
+        if gaps:
+            self.warnings.append(f"{gaps} of {self.max_roll} rolls are not covered by any row")
+        self.lookup = numpy.array(lookup, dtype=numpy.int32) if numpy is not None else lookup
+        self.macros = {index: MACRO_PATTERN.match(row.get('result') or '').group(1).lower()
+                       for index, row in enumerate(self.rows) if is_macro(row.get('result'))}
+
+    def describe(self):
+        return {'id': self.id, 'name': self.name, 'max_roll': self.max_roll, 'rows': len(self.rows),
+                'macros': sorted(set(self.macros.values())), 'warnings': self.warnings}
+
+
+class Dice:
+    """Seeded random source; NumPy's generator when available."""
+
+    def __init__(self, seed):
+        self.seed = seed
+        if numpy is not None:
+            self._rng = numpy.random.default_rng(seed)
+            self.engine = 'numpy'
+        else:
+            self._rng = random.Random(seed)
+            self.engine = 'python'
+
+    def roll(self, sides):
+        if numpy is not None:
+            return int(self._rng.integers(1, sides + 1))
+        return self._rng.randint(1, sides)
+
+    def row_counts(self, table, count):
+        """Roll ``table`` ``count`` times; hits per row index (last slot = gaps)."""
+        if numpy is not None:
+            counts = numpy.zeros(len(table.rows) + 1, dtype=numpy.int64)
+            for start in range(0, count, ROLL_CHUNK_SIZE):
+                rows = table.lookup[self._rng.integers(0, table.max_roll, size=min(ROLL_CHUNK_SIZE, count - start))]
+                counts += numpy.bincount(rows, minlength=len(table.rows) + 1)
+            return counts.tolist()
+        counts = [0] * (len(table.rows) + 1)
+        lookup, randrange, sides = table.lookup, self._rng.randrange, table.max_roll
+        for _ in range(count):
+            counts[lookup[randrange(sides)]] += 1
+        return counts
+
+
+class RollEngine:
+    """Compiled tables from the corpus plus macro-aware single and bulk rolls.
+
+    Macro rows expand into further rolls: ROLL TWICE rolls the same table
+    twice, the paired macros roll on tables of those names (looked up in the
+    same file first, then the whole corpus) and OBJECTIVES rolls the file's
+    Objectives table. Expansion stops at ``max_depth``; macros without a
+    matching table (e.g. CONNECTION WEB, THE WEAVE) are returned as is."""
+
+    MACRO_TARGETS = {
+        'roll twice': (None, None),
+        'action + theme': ('action', 'theme'),
+        'descriptor + focus': ('descriptor', 'focus'),
+        'objectives': ('objectives',),
+        'connection web': (),
+        'the weave': (),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}         # lower-cased id -> CompiledTable
+        self._files = {}          # source -> (mtime_ns, [ids])
+        self._directory = None
+        self._last_refresh = 0.0
+
+    def compile_file(self, path, source):
+        with open(path, encoding='utf-8') as f:
+            tables = json.load(f)
+        if isinstance(tables, dict):
+            tables = tables.get('tables', [])
+        compiled = [CompiledTable(table_id, source, table) for table_id, table in zip(table_ids(source, tables), tables)]
+        with self._lock:
+            for table_id in self._files.get(source, (None, []))[1]:
+                self._tables.pop(table_id.lower(), None)
+            for table in compiled:
+                self._tables[table.id.lower()] = table
+            self._files[source] = (os.stat(path).st_mtime_ns, [table.id for table in compiled])
+        return len(compiled)
+
+    def load_directory(self, directory):
+        self._directory = Path(directory)
+        self.refresh(force=True)
+        return len(self._tables)
+
+    def refresh(self, force=False):
+        """Recompile files whose mtime changed (at most every ROLL_REFRESH_SECONDS)."""
+        if self._directory is None or (not force and time.monotonic() - self._last_refresh < ROLL_REFRESH_SECONDS):
+            return
+        self._last_refresh = time.monotonic()
+        present = set()
+        for path in sorted(self._directory.glob('**/*.json')):
+            source = path.relative_to(self._directory).with_suffix('').as_posix()
+            present.add(source)
+            try:
+                if self._files.get(source, (None,))[0] != path.stat().st_mtime_ns:
+                    self.compile_file(path, source)
+            except (OSError, ValueError, AttributeError, TypeError) as e:
+                log.warning('roll_table_compile_failed', path=str(path), error=str(e))
+        with self._lock:
+            for source in set(self._files) - present:
+                for table_id in self._files.pop(source)[1]:
+                    self._tables.pop(table_id.lower(), None)
+
+    def tables(self):
+        with self._lock:
+            return [table.describe() for table in self._tables.values()]
+
+    def find(self, table_id):
+        with self._lock:
+            return self._tables.get((table_id or '').strip('/').lower())
+
+    def macro_targets(self, table, macro):
+        targets = []
+        for name in self.MACRO_TARGETS.get(macro, ()):
+            if name is None:
+                targets.append(table)
+                continue
+            target = self.find(f'{table.source}/{name}')
+            if target is None:
+                with self._lock:
+                    target = next((t for t in self._tables.values() if t.name.lower() == name), None)
+            if target is None:
+                return []
+            targets.append(target)
+        return targets
+
+    def roll_one(self, table, dice, depth, max_depth):
+        roll = dice.roll(table.max_roll)
+        index = table.lookup[roll - 1]
+        row = table.rows[index] if index < len(table.rows) else None
+        result = {'table': table.id, 'roll': roll, 'result': row.get('result') if row else None}
+        macro = table.macros.get(int(index))
+        if macro:
+            result['macro'] = macro.upper()
+            targets = self.macro_targets(table, macro)
+            if targets and depth >= max_depth:
+                result['truncated'] = True
+            elif targets:
+                result['expansions'] = [self.roll_one(target, dice, depth + 1, max_depth) for target in targets]
+        return result
+
+    def roll_bulk(self, table, count, dice, depth, max_depth, tally):
+        """Roll ``count`` times, expanding macro hits in bulk. Adds every
+        roll (expansions included) to ``tally`` and returns this level's row
+        counts plus the number of expansions cut off by ``max_depth``."""
+        counts = dice.row_counts(table, count)
+        totals = tally.setdefault(table.id, [0] * len(counts))
+        for index, hits in enumerate(counts):
+            totals[index] += hits
+        truncated = 0
+        for index, macro in table.macros.items():
+            hits = counts[index]
+            if not hits:
+                continue
+            targets = self.macro_targets(table, macro)
+            if not targets:
+                continue
+            if depth >= max_depth:
+                truncated += hits
+                continue
+            for target in targets:
+                truncated += self.roll_bulk(target, hits, dice, depth + 1, max_depth, tally)[1]
+        return counts, truncated
+
+    def histogram(self, table, counts, total):
+        rows = []
+        for index, row in enumerate(table.rows):
+            width = max(0, min(int(row.get('ceiling', 0)), table.max_roll) - max(int(row.get('floor', 0)), 1) + 1)
+            rows.append({
+                'floor': row.get('floor'),
+                'ceiling': row.get('ceiling'),
+                'result': row.get('result'),
+                'hits': counts[index],
+                'share': round(counts[index] / total, 6) if total else 0.0,
+                'expected_share': round(width / table.max_roll, 6),
+            })
+        if counts[-1]:
+            rows.append({'floor': None, 'ceiling': None, 'result': None, 'hits': counts[-1],
+                         'share': round(counts[-1] / total, 6), 'expected_share': 0.0})
+        return rows
+
+    def roll(self, table_id, count=1, seed=None, resolve_macros=True, max_depth=ROLL_MAX_MACRO_DEPTH,
+             detailed=None):
+        self.refresh()
+        table = self.find(table_id)
+        if table is None:
+            return {'error': f"Unknown table '{table_id}'"}
+        if count < 1 or count > ROLL_MAX_COUNT:
+            return {'error': f'count must be between 1 and {ROLL_MAX_COUNT}'}
+        if seed is None:
+            seed = random.randrange(2 ** 63)
+        max_depth = max(0, min(int(max_depth), ROLL_MAX_MACRO_DEPTH_LIMIT)) if resolve_macros else 0
+        if detailed is None:
+            detailed = count <= ROLL_MAX_DETAILED
+        elif detailed and count > ROLL_MAX_DETAILED:
+            return {'error': f'detailed results are limited to {ROLL_MAX_DETAILED} rolls'}
+
+        dice = Dice(seed)
+        response = {'table': table.id, 'count': count, 'seed': seed, 'engine': dice.engine, 'max_depth': max_depth}
+        tally = {}
+        if detailed:
+            rolls = [self.roll_one(table, dice, 0, max_depth) for _ in range(count)]
+            response['rolls'] = rolls
+            direct = [0] * (len(table.rows) + 1)
+            for item in rolls:
+                direct[table.lookup[item['roll'] - 1]] += 1
+            truncated = 0
+            stack = list(rolls)
+            while stack:
+                item = stack.pop()
+                target = self.find(item['table'])
+                counts = tally.setdefault(target.id, [0] * (len(target.rows) + 1))
+                counts[target.lookup[item['roll'] - 1]] += 1
+                truncated += bool(item.get('truncated'))
+                stack.extend(item.get('expansions', ()))
+        else:
+            direct, truncated = self.roll_bulk(table, count, dice, 0, max_depth, tally)
+
+        response['histogram'] = self.histogram(table, direct, count)
+        response['chi_square'] = round(sum(
+            (row['hits'] - row['expected_share'] * count) ** 2 / (row['expected_share'] * count)
+            for row in response['histogram'] if row['expected_share']), 4)
+        if len(tally) > 1 or sum(tally[table.id]) != count:
+            # Every roll made, macro expansions included, per table
+            response['resolved'] = {
+                table_id: self.histogram(self.find(table_id), counts, sum(counts))
+                for table_id, counts in tally.items()
+            }
+        response['macros_truncated'] = truncated
+        if table.warnings:
+            response['warnings'] = table.warnings
+        return response
+
+
+roll_engine = RollEngine()
+
+
+class TableCorpus:
+    """SQLite copy of the table corpus with an FTS5 index over table text
+    and row results.
+
+    ``sync`` only re-parses JSON files whose size/mtime changed and whose
+    content hash differs from the stored one, so startup cost tracks what
+    changed rather than the size of the corpus. Tags are normalised the way
+    tableRegistry.ts does it (own tags + category + parent + oracle type)."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            source TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, sha1 TEXT);
+        CREATE TABLE IF NOT EXISTS tables (
+            rowid INTEGER PRIMARY KEY, table_id TEXT UNIQUE, source TEXT, registry_id TEXT, name TEXT,
+            parent TEXT, category TEXT, oracle_type TEXT, summary TEXT, description TEXT, tags TEXT,
+            max_roll INTEGER, row_count INTEGER, position INTEGER);
+        CREATE INDEX IF NOT EXISTS tables_source ON tables(source);
+        CREATE TABLE IF NOT EXISTS table_tags (table_rowid INTEGER, tag TEXT);
+        CREATE INDEX IF NOT EXISTS table_tags_tag ON table_tags(tag, table_rowid);
+        CREATE INDEX IF NOT EXISTS table_tags_table ON table_tags(table_rowid);
+        CREATE TABLE IF NOT EXISTS rows (
+            rowid INTEGER PRIMARY KEY, table_rowid INTEGER, floor INTEGER, ceiling INTEGER, result TEXT);
+        CREATE INDEX IF NOT EXISTS rows_table ON rows(table_rowid, floor);
+    """
+
+    def __init__(self, db_path, directory):
+        self.db_path = Path(db_path)
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._db = None
+        self.fts = False
+        self._last_refresh = 0.0
+
+    def _connect(self):
+        if self._db is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(self.SCHEMA)
+            try:
+                # kind is 'table' (name/summary/description) or 'row'; ref points at tables/rows
+                self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5("
+                                 "text, kind UNINDEXED, ref UNINDEXED, table_rowid UNINDEXED, "
+                                 "tokenize='porter unicode61')")
+                self.fts = True
+            except sqlite3.OperationalError:
+                # Python builds without FTS5 fall back to LIKE scans
+                self.fts = False
+        return self._db
+
+    def sync(self, force=False):
+        """Bring the database in line with the JSON files. Returns the
+        sources that were (re)compiled or removed."""
+        if not force and time.monotonic() - self._last_refresh < CORPUS_REFRESH_SECONDS:
+            return []
+        self._last_refresh = time.monotonic()
+        if not self.directory.is_dir():
+            return []
+        changed = []
+        with self._lock:
+            db = self._connect()
+            known = {row['source']: row for row in db.execute('SELECT * FROM files')}
+            present = set()
+            for path in sorted(self.directory.glob('**/*.json')):
+                source = path.relative_to(self.directory).with_suffix('').as_posix()
+                present.add(source)
+                try:
+                    stat = path.stat()
+                    stored = known.get(source)
+                    if stored and stored['mtime_ns'] == stat.st_mtime_ns and stored['size'] == stat.st_size:
+                        continue
+                    body = path.read_bytes()
+                    digest = hashlib.sha1(body).hexdigest()
+                    with db:
+                        if not stored or stored['sha1'] != digest:
+                            self._replace_source(db, source, json.loads(body.decode('utf-8')))
+                            changed.append(source)
+                        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                   (source, stat.st_mtime_ns, stat.st_size, digest))
+                except (OSError, ValueError, AttributeError, TypeError, sqlite3.Error) as e:
+                    log.warning('corpus_compile_failed', path=str(path), error=str(e))
+            for source in set(known) - present:
+                with db:
+                    self._delete_source(db, source)
+                    db.execute('DELETE FROM files WHERE source = ?', (source,))
+                changed.append(source)
+        if changed:
+            log.info('corpus_synced', changed=len(changed), sources=changed[:20])
+        return changed
+
+    def _delete_source(self, db, source):
+        ids = [row[0] for row in db.execute('SELECT rowid FROM tables WHERE source = ?', (source,))]
+        for table_rowid in ids:
+            db.execute('DELETE FROM rows WHERE table_rowid = ?', (table_rowid,))
+            db.execute('DELETE FROM table_tags WHERE table_rowid = ?', (table_rowid,))
+            if self.fts:
+                db.execute('DELETE FROM search WHERE table_rowid = ?', (table_rowid,))
+        db.execute('DELETE FROM tables WHERE source = ?', (source,))
+
+    def _replace_source(self, db, source, tables):
+        self._delete_source(db, source)
+        if isinstance(tables, dict):
+            tables = tables.get('tables', [])
+        folder = source.split('/')[0] if '/' in source else ''
+        category = {'domains': 'Domain', 'aspects': 'Aspect'}.get(folder, 'Other')
+        slug = source.rsplit('/', 1)[-1]
+        parent = slug[:1].upper() + slug[1:]
+        for position, (table_id, table) in enumerate(zip(table_ids(source, tables), tables)):
+            oracle_type = table.get('oracle_type') or table.get('name') or f'Table {position + 1}'
+            tags = list(dict.fromkeys([*(table.get('tags') or []), category.lower(), parent.lower(),
+                                       oracle_type.lower()]))
+            rows = [row for row in table.get('tableData', []) if isinstance(row, dict)]
+            cursor = db.execute(
+                'INSERT INTO tables (table_id, source, registry_id, name, parent, category, oracle_type, summary, '
+                'description, tags, max_roll, row_count, position) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (table_id, source, f'{category}:{parent}:{oracle_type}',
+                 table.get('name', ''), parent, category, oracle_type, table.get('summary', ''),
+                 table.get('description', ''), json.dumps(tags), table.get('maxRoll'), len(rows), position))
+            table_rowid = cursor.lastrowid
+            db.executemany('INSERT INTO table_tags VALUES (?, ?)', [(table_rowid, tag) for tag in tags])
+            db.executemany('INSERT INTO rows (table_rowid, floor, ceiling, result) VALUES (?, ?, ?, ?)',
+                           [(table_rowid, row.get('floor'), row.get('ceiling'), row.get('result', '')) for row in rows])
+            if self.fts:
+                text = ' '.join(filter(None, [parent, table.get('name'), table.get('summary'), table.get('description')]))
+                db.execute('INSERT INTO search VALUES (?, ?, ?, ?)', (text, 'table', table_rowid, table_rowid))
+                db.execute("INSERT INTO search SELECT result, 'row', rowid, table_rowid FROM rows "
+                           "WHERE table_rowid = ? AND result != ''", (table_rowid,))
+
+    @staticmethod
+    def _describe(row):
+        return {
+            'id': row['table_id'],
+            'registry_id': row['registry_id'],
+            'source': row['source'],
+            'name': row['name'],
+            'parent': row['parent'],
+            'category': row['category'],
+            'oracle_type': row['oracle_type'],
+            'summary': row['summary'],
+            'tags': json.loads(row['tags']),
+            'max_roll': row['max_roll'],
+            'rows': row['row_count'],
+        }
+
+    @staticmethod
+    def _filters(category=None, tags=(), source=None):
+        clauses, params = [], []
+        if category:
+            clauses.append('t.category = ? COLLATE NOCASE')
+            params.append(category)
+        if source:
+            clauses.append('t.source = ?')
+            params.append(source.strip('/'))
+        for tag in tags:
+            clauses.append('t.rowid IN (SELECT table_rowid FROM table_tags WHERE tag = ?)')
+            params.append(tag.lower())
+        return clauses, params
+
+    def list_tables(self, category=None, tags=(), source=None):
+        self.sync()
+        clauses, params = self._filters(category, tags, source)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        with self._lock:
+            rows = self._connect().execute(f'SELECT * FROM tables t{where} ORDER BY t.source, t.position',
+                                           params).fetchall()
+        return [self._describe(row) for row in rows]
+
+    def get_table(self, table_id):
+        """A table in ForgeTable shape (with tableData), or None."""
+        self.sync()
+        with self._lock:
+            db = self._connect()
+            row = db.execute('SELECT * FROM tables WHERE table_id = ? COLLATE NOCASE',
+                             ((table_id or '').strip('/'),)).fetchone()
+            if row is None:
+                return None
+            data = db.execute('SELECT floor, ceiling, result FROM rows WHERE table_rowid = ? ORDER BY floor, rowid',
+                              (row['rowid'],)).fetchall()
+        table = self._describe(row)
+        table['description'] = row['description']
+        table['tableData'] = [dict(item) for item in data]
+        return table
+
+    @staticmethod
+    def fts_query(text):
+        # Quote every term so user input can't inject FTS syntax; the last one matches as a prefix
+        terms = re.findall(r'\w+', text or '')
+        if not terms:
+            return None
+        quoted = ['"' + term.replace('"', '""') + '"' for term in terms]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def search(self, query, category=None, tags=(), source=None, limit=20):
+        self.sync()
+        limit = max(1, min(int(limit), SEARCH_MAX_RESULTS))
+        clauses, params = self._filters(category, tags, source)
+        extra = ''.join(' AND ' + clause for clause in clauses)
+        with self._lock:
+            db = self._connect()
+            if self.fts:
+                match = self.fts_query(query)
+                if match is None:
+                    return []
+                rows = db.execute(
+                    "SELECT s.kind, t.*, r.floor AS row_floor, r.ceiling AS row_ceiling, r.result AS row_result, "
+                    "snippet(search, 0, '[', ']', '...', 12) AS snippet, bm25(search) AS score "
+                    "FROM search s JOIN tables t ON t.rowid = s.table_rowid "
+                    "LEFT JOIN rows r ON s.kind = 'row' AND r.rowid = s.ref "
+                    f"WHERE search MATCH ?{extra} ORDER BY score LIMIT ?",
+                    [match, *params, limit]).fetchall()
+            else:
+                rows = db.execute(
+                    "SELECT 'row' AS kind, t.*, r.floor AS row_floor, r.ceiling AS row_ceiling, r.result AS row_result, "
+                    "r.result AS snippet, 0 AS score FROM rows r "
+                    f"JOIN tables t ON t.rowid = r.table_rowid WHERE r.result LIKE ?{extra} LIMIT ?",
+                    [f'%{query}%', *params, limit]).fetchall()
+        hits = []
+        for row in rows:
+            hit = {'kind': row['kind'], 'table': self._describe(row), 'snippet': row['snippet'],
+                   'score': round(-row['score'], 4)}
+            if row['kind'] == 'row':
+                hit.update(floor=row['row_floor'], ceiling=row['row_ceiling'], result=row['row_result'])
+            hits.append(hit)
+        return hits
+
+    def stats(self):
+        with self._lock:
+            db = self._connect()
+            return {
+                'files': db.execute('SELECT COUNT(*) FROM files').fetchone()[0],
+                'tables': db.execute('SELECT COUNT(*) FROM tables').fetchone()[0],
+                'rows': db.execute('SELECT COUNT(*) FROM rows').fetchone()[0],
+                'fts5': self.fts,
+            }
+
+
+table_corpus = TableCorpus(CORPUS_DB_PATH, CORPUS_DIR)
+
+
+class JobQueue:
+    """Background generation/review jobs with per-step checkpoints.
+
+    A job is split into steps (one per table); every finished step is
+    written to SQLite before the next result is awaited, so a job that is
+    interrupted - refresh, timeout or restart - only re-runs the steps that
+    never completed. API keys live in memory only."""
+
+    KINDS = ('generate-file', 'batch-generate', 'batch-review')
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, kind TEXT, status TEXT, request TEXT, use_cache INTEGER,
+            total_steps INTEGER, done_steps INTEGER DEFAULT 0, error TEXT, result TEXT,
+            created REAL, updated REAL);
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created);
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            job_id TEXT, step INTEGER, outcome TEXT, created REAL, PRIMARY KEY (job_id, step));
+    """
+
+    def __init__(self, db_path, workers=JOB_WORKERS):
+        self.db_path = Path(db_path)
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._db = None
+        self._queue = queue.Queue()
+        self._keys = {}
+        self._cancelled = set()
+        self._started = False
+
+    def _connect(self):
+        if self._db is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+    def _execute_sql(self, sql, params=()):
+        with self._lock:
+            db = self._connect()
+            with db:
+                return db.execute(sql, params).fetchall()
+
+    def _set(self, job_id, **fields):
+        fields['updated'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._execute_sql(f'UPDATE jobs SET {assignments} WHERE id = ?', [*fields.values(), job_id])
+
+    def start(self):
+        """Resume interrupted jobs and start the workers (idempotent).
+        Returns how many jobs were resumed and paused."""
+        with self._lock:
+            if self._started:
+                return {'resumed': 0, 'paused': 0}
+            self._started = True
+        recovered = self._recover()
+        for index in range(self.workers):
+            threading.Thread(target=self._work, name=f'anvil-job-{index}', daemon=True).start()
+        return recovered
+
+    def _recover(self):
+        env_key = os.environ.get('OPENAI_API_KEY')
+        interrupted = self._execute_sql(
+            "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created")
+        for row in interrupted:
+            if env_key:
+                self._keys[row['id']] = env_key
+                self._set(row['id'], status='queued', error=None)
+                self._queue.put(row['id'])
+            else:
+                self._set(row['id'], status='paused',
+                          error='Interrupted by a server restart; resume with an API key')
+        if interrupted:
+            log.info('jobs_recovered', jobs=len(interrupted), resumed=bool(env_key))
+        resumed = len(interrupted) if env_key else 0
+        return {'resumed': resumed, 'paused': len(interrupted) - resumed}
+
+    @staticmethod
+    def steps(kind, request):
+        if kind == 'generate-file':
+            return plan_file_generation(request)[1]
+        if kind == 'batch-review' and 'tables' in request:
+            shared = {key: value for key, value in request.items() if key != 'tables'}
+            return [dict(shared, table=table) for table in request['tables']]
+        return [request]
+
+    def submit(self, kind, request, api_key, use_cache=True):
+        if kind not in self.KINDS:
+            return {'error': f"Unknown job kind '{kind}' (expected one of {', '.join(self.KINDS)})"}
+        request = {key: value for key, value in request.items()
+                   if key != 'async' and key.lower() not in JsonLogger.REDACT_FIELDS}
+        total = len(self.steps(kind, request))
+        self.start()  # recover first, so the new job isn't mistaken for an interrupted one
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute_sql('INSERT INTO jobs (id, kind, status, request, use_cache, total_steps, created, updated) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (job_id, kind, 'queued', json.dumps(request), int(use_cache), total, now, now))
+        self._keys[job_id] = api_key
+        self._queue.put(job_id)
+        log.info('job_submitted', job=job_id, kind=kind, steps=total)
+        return self.get(job_id, include_partial=False)
+
+    def resume(self, job_id, api_key=None):
+        self.start()
+        rows = self._execute_sql('SELECT status FROM jobs WHERE id = ?', (job_id,))
+        if not rows:
+            return None
+        if rows[0]['status'] not in ('paused', 'failed', 'cancelled'):
+            return {'error': f"Job is {rows[0]['status']}; only paused, failed or cancelled jobs can be resumed"}
+        api_key = api_key or self._keys.get(job_id) or os.environ.get('OPENAI_API_KEY')
+        if not api_key:
+            return {'error': 'API key required to resume this job'}
+        self._keys[job_id] = api_key
+        self._cancelled.discard(job_id)
+        self._set(job_id, status='queued', error=None)
+        self._queue.put(job_id)
+        return self.get(job_id, include_partial=False)
+
+    def cancel(self, job_id):
+        rows = self._execute_sql('SELECT status FROM jobs WHERE id = ?', (job_id,))
+        if not rows:
+            return None
+        if rows[0]['status'] in ('queued', 'running', 'paused'):
+            self._cancelled.add(job_id)
+            if rows[0]['status'] != 'running':
+                self._set(job_id, status='cancelled')
+        return self.get(job_id, include_partial=False)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                log.error('job_failed', job=job_id, error=str(e))
+                self._set(job_id, status='failed', error=f'Job failed: {str(e)}')
+
+    def _checkpoints(self, job_id):
+        rows = self._execute_sql('SELECT step, outcome FROM checkpoints WHERE job_id = ?', (job_id,))
+        return {row['step']: json.loads(row['outcome']) for row in rows}
+
+    def _run_step(self, kind, step, api_key, use_cache):
+        if kind == 'batch-review':
+            return {'result': review_table(step, api_key, priority=PRIORITY_BULK)}
+        request = step[2] if kind == 'generate-file' else step
+        result, cache_status = run_batch_generation(request, api_key, use_cache, priority=PRIORITY_BULK)
+        return {'result': result, 'cache': cache_status}
+
+    @staticmethod
+    def step_error(result):
+        """Why a step's result can't be checkpointed, or None. Partial
+        outcomes count as failures so resuming retries them."""
+        if result.get('error'):
+            return result['error']
+        if result.get('errors'):
+            return result['errors'][0]
+        missing = sum(1 for decision in result.get('decisions', []) if decision.get('decision') is None)
+        if missing:
+            return f'{missing} rows have no review decision'
+        return None
+
+    def _run(self, job_id):
+        rows = self._execute_sql('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        if not rows or rows[0]['status'] != 'queued':
+            return
+        job = rows[0]
+        api_key = self._keys.get(job_id)
+        if not api_key:
+            self._set(job_id, status='paused', error='API key required to run this job')
+            return
+        request = json.loads(job['request'])
+        steps = self.steps(job['kind'], request)
+        done = self._checkpoints(job_id)
+        pending = [index for index in range(len(steps)) if index not in done]
+        self._set(job_id, status='running', done_steps=len(done))
+        log.info('job_started', job=job_id, kind=job['kind'], pending=len(pending), checkpointed=len(done))
+
+        errors = []
+        if pending:
+            with ThreadPoolExecutor(max_workers=min(FANOUT_CONCURRENCY, len(pending)),
+                                    thread_name_prefix='anvil-job-step') as pool:
+                futures = {pool.submit(self._run_step, job['kind'], steps[index], api_key, bool(job['use_cache'])): index
+                           for index in pending}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        outcome = {'result': {'error': f'Step failed: {str(e)}'}}
+                    error = self.step_error(outcome['result'])
+                    if error:
+                        errors.append(error)
+                    else:
+                        self._execute_sql('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+                                          (job_id, index, json.dumps(outcome), time.time()))
+                        done[index] = outcome
+                        self._set(job_id, done_steps=len(done))
+                    if job_id in self._cancelled:
+                        for other in futures:
+                            other.cancel()
+
+        if job_id in self._cancelled:
+            self._cancelled.discard(job_id)
+            self._set(job_id, status='cancelled')
+        elif errors:
+            self._set(job_id, status='failed', error=errors[0])
+        else:
+            result = self.assemble(job['kind'], request, done)
+            self._set(job_id, status='completed', result=json.dumps(result))
+            self._keys.pop(job_id, None)
+        log.info('job_finished', job=job_id, done=len(done), total=len(steps), errors=len(errors))
+
+    def assemble(self, kind, request, done):
+        """The endpoint-shaped result from the checkpoints so far."""
+        if kind == 'generate-file':
+            document, steps = plan_file_generation(request)
+            summary = []
+            for index, step in enumerate(steps):
+                if index in done:
+                    summary.append(fill_file_table(step, done[index]['result'], done[index].get('cache')))
+                else:
+                    summary.append({'name': step[0].get('name'), 'table_type': step[2]['table_type'],
+                                    'requested': len(step[1]), 'filled': 0, 'pending': True})
+            return {'document': document, 'tables': summary}
+        if kind == 'batch-review' and 'tables' in request:
+            return {'reviews': [done[index]['result'] if index in done else None
+                                for index in range(len(request['tables']))]}
+        return done[0]['result'] if 0 in done else None
+
+    def get(self, job_id, include_partial=True):
+        rows = self._execute_sql('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        if not rows:
+            return None
+        job = rows[0]
+        response = {
+            'id': job['id'],
+            'kind': job['kind'],
+            'status': job['status'],
+            'progress': {'done': job['done_steps'], 'total': job['total_steps']},
+            'created': job['created'],
+            'updated': job['updated'],
+        }
+        if job['error']:
+            response['error'] = job['error']
+        if job['result'] is not None:
+            response['result'] = json.loads(job['result'])
+        elif include_partial and job['done_steps']:
+            response['partial'] = self.assemble(job['kind'], json.loads(job['request']), self._checkpoints(job_id))
+        return response
+
+    def list(self, limit=JOB_HISTORY_LIMIT):
+        rows = self._execute_sql('SELECT id FROM jobs ORDER BY created DESC LIMIT ?', (limit,))
+        return [self.get(row['id'], include_partial=False) for row in rows]
+
+    def stats(self):
+        rows = self._execute_sql('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status')
+        return {row['status']: row['count'] for row in rows}
+
+
+job_queue = JobQueue(JOBS_DB_PATH)
+
+
+class StaticFileCache:
+    """In-memory cache of compressible static files.
+
+    Each entry holds the identity body, its strong ETag and precompressed
+    gzip/brotli variants. Entries are checked against the file's mtime and
+    size on every lookup, so edits to index.html show up on the next load."""
+
+    def __init__(self, max_file_bytes=STATIC_CACHE_MAX_FILE_BYTES):
+        self.max_file_bytes = max_file_bytes
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_compressible(path):
+        return os.path.splitext(path)[1].lower() in STATIC_COMPRESSIBLE_EXTENSIONS
+
+    def get(self, path, stat):
+        if stat.st_size > self.max_file_bytes or not self.is_compressible(path):
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry
+        return self._load(path, stat)
+
+    def _load(self, path, stat):
+        with open(path, 'rb') as f:
+            body = f.read()
+        entry = {
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'etag': '"' + hashlib.sha1(body).hexdigest() + '"',
+            'variants': {'identity': body},
+        }
+        if len(body) >= STATIC_COMPRESS_MIN_BYTES:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                entry['variants']['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(body)
+                if len(compressed) < len(body):
+                    entry['variants']['br'] = compressed
+        with self._lock:
+            self._entries[path] = entry
+        return entry
+
+    def warm(self, root, max_files=STATIC_PRECOMPRESS_MAX_FILES):
+        """Precompress the text assets under ``root`` so first loads are fast."""
+        loaded = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d not in STATIC_SKIP_DIRS]
+            for filename in filenames:
+                if loaded >= max_files:
+                    return loaded
+                path = os.path.join(dirpath, filename)
+                try:
+                    if self.get(path, os.stat(path)) is not None:
+                        loaded += 1
+                except OSError:
+                    continue
+        return loaded
+
+
+static_cache = StaticFileCache()
+
+
+def parse_byte_range(header, size):
+    """Parse a single-range ``Range: bytes=...`` header.
+
+    Returns ``(start, end)`` inclusive, ``None`` if the header should be
+    ignored (absent, malformed or multi-range), or ``'unsatisfiable'``."""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start_text, _, end_text = header[6:].strip().partition('-')
+    try:
+        if not start_text:
+            length = int(end_text)
+            if length <= 0:
+                return 'unsatisfiable'
+            return max(0, size - length), size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return 'unsatisfiable'
+    return start, min(end, size - 1)
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    candidates = [tag.strip() for tag in header.split(',')]
+    return any(tag.removeprefix('W/') == etag for tag in candidates)
+
+
+def accepted_encodings(header):
+    encodings = set()
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+class JSONPatchError(ValueError):
+    """A JSON Patch (RFC 6902) operation could not be applied."""
+
+
+def json_pointer(pointer):
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise JSONPatchError(f"Invalid JSON pointer '{pointer}'")
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def apply_json_patch(document, operations):
+    """Apply RFC 6902 operations to a copy of ``document``. All or nothing:
+    the original is untouched if any operation fails."""
+    document = copy.deepcopy(document)
+
+    def parent_of(tokens):
+        target = document
+        for token in tokens[:-1]:
+            try:
+                target = target[int(token)] if isinstance(target, list) else target[token]
+            except (KeyError, IndexError, ValueError, TypeError):
+                raise JSONPatchError(f"Path '/{'/'.join(tokens)}' does not exist")
+        return target
+
+    def get(tokens):
+        if not tokens:
+            return document
+        parent, key = parent_of(tokens), tokens[-1]
+        try:
+            return parent[int(key)] if isinstance(parent, list) else parent[key]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise JSONPatchError(f"Path '/{'/'.join(tokens)}' does not exist")
+
+    def remove(tokens):
+        value = get(tokens)
+        parent, key = parent_of(tokens), tokens[-1]
+        if isinstance(parent, list):
+            del parent[int(key)]
+        else:
+            del parent[key]
+        return value
+
+    def add(tokens, value):
+        nonlocal document
+        if not tokens:
+            document = value
+            return
+        parent, key = parent_of(tokens), tokens[-1]
+        if isinstance(parent, list):
+            index = len(parent) if key == '-' else int(key)
+            if not 0 <= index <= len(parent):
+                raise JSONPatchError(f"Index {key} out of range")
+            parent.insert(index, value)
+        elif isinstance(parent, dict):
+            parent[key] = value
+        else:
+            raise JSONPatchError(f"Cannot add to '/{'/'.join(tokens[:-1])}'")
+
+    for operation in operations:
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise JSONPatchError('Each operation needs an op and a path')
+        op, tokens = operation['op'], json_pointer(operation['path'])
+        try:
+            if op == 'add':
+                add(tokens, copy.deepcopy(operation['value']))
+            elif op == 'remove':
+                remove(tokens)
+            elif op == 'replace':
+                get(tokens)
+                if tokens:
+                    remove(tokens)
+                add(tokens, copy.deepcopy(operation['value']))
+            elif op == 'move':
+                add(tokens, remove(json_pointer(operation['from'])))
+            elif op == 'copy':
+                add(tokens, copy.deepcopy(get(json_pointer(operation['from']))))
+            elif op == 'test':
+                if get(tokens) != operation['value']:
+                    raise JSONPatchError(f"Test failed at '{operation['path']}'")
+            else:
+                raise JSONPatchError(f"Unknown op '{op}'")
+        except KeyError as e:
+            raise JSONPatchError(f"'{op}' operation is missing {e}")
+    return document
+
+
+class TableFileStore:
+    """Table JSON files under the tables directory, edited in memory and
+    written behind.
+
+    Each file is loaded once and versioned with an ETag; PUT/PATCH requests
+    must quote the current ETag (If-Match) and only the patch crosses the
+    wire. Changes mark the file dirty and a background flusher writes it -
+    temp file, fsync, rename - once edits have been quiet for
+    TABLE_WRITE_DELAY_SECONDS (or TABLE_WRITE_MAX_DELAY_SECONDS after the
+    first unsaved edit), so a burst of row edits costs one fsync."""
+
+    SOURCE_PATTERN = re.compile(r'^[A-Za-z0-9_\-]+(/[A-Za-z0-9_\-]+)*$')
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._files = {}
+        self._flusher = None
+        self.writes = 0
+        self.coalesced = 0
+
+    def path_for(self, source):
+        source = (source or '').strip('/').removesuffix('.json')
+        if not self.SOURCE_PATTERN.match(source):
+            raise ValueError(f"Invalid table file name '{source}'")
+        return source, self.directory / f'{source}.json'
+
+    def _load(self, source, path):
+        try:
+            body = path.read_bytes()
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        return {
+            'path': path,
+            'doc': json.loads(body.decode('utf-8')),
+            'etag': '"' + hashlib.sha1(body).hexdigest()[:20] + '"',
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'dirty_since': None,
+            'last_change': None,
+            'writing': False,
+        }
+
+    def _entry(self, source):
+        """Current entry for ``source`` (caller holds ``_cond``). Clean
+        entries are reloaded when the file was changed by something else;
+        one being flushed isn't, as its new stat isn't recorded yet."""
+        source, path = self.path_for(source)
+        entry = self._files.get(source)
+        if entry is not None and entry['dirty_since'] is None and not entry['writing']:
+            try:
+                stat = path.stat()
+                if (stat.st_mtime_ns, stat.st_size) != (entry['mtime_ns'], entry['size']):
+                    entry = None
+            except FileNotFoundError:
+                entry = None
+        if entry is None:
+            entry = self._load(source, path)
+            if entry is None:
+                self._files.pop(source, None)
+                return source, None
+            self._files[source] = entry
+        return source, entry
+
+    def get(self, source):
+        with self._cond:
+            _, entry = self._entry(source)
+            return (entry['doc'], entry['etag']) if entry else (None, None)
+
+    def list(self):
+        files = {}
+        if self.directory.is_dir():
+            for path in sorted(self.directory.glob('**/*.json')):
+                source = path.relative_to(self.directory).with_suffix('').as_posix()
+                stat = path.stat()
+                files[source] = {'source': source, 'size': stat.st_size, 'modified': stat.st_mtime}
+        with self._cond:
+            for source, entry in self._files.items():
+                item = files.setdefault(source, {'source': source, 'size': None, 'modified': None})
+                item['etag'] = entry['etag']
+                item['pending_write'] = entry['dirty_since'] is not None
+        return list(files.values())
+
+    def _commit(self, source, entry, doc, change):
+        # The new ETag chains the old one with the change, so it costs O(patch) rather than O(file)
+        entry['doc'] = doc
+        entry['etag'] = '"' + hashlib.sha1(entry['etag'].encode() + change).hexdigest()[:20] + '"'
+        now = time.monotonic()
+        if entry['dirty_since'] is None:
+            entry['dirty_since'] = now
+        else:
+            self.coalesced += 1
+        entry['last_change'] = now
+        self._files[source] = entry
+        self._ensure_flusher()
+        self._cond.notify_all()
+        return entry['etag']
+
+    @staticmethod
+    def validate(doc):
+        """Raise ValueError unless ``doc`` is a tables file: a list of
+        tables, or ``{"tables": [...]}``, each table with a tableData list."""
+        tables = doc.get('tables') if isinstance(doc, dict) else doc
+        if not isinstance(tables, list):
+            raise ValueError('Expected a list of tables or {"tables": [...]}')
+        for position, table in enumerate(tables):
+            if not isinstance(table, dict) or not isinstance(table.get('tableData'), list):
+                raise ValueError(f'Table {position} needs a tableData list')
+            if not all(isinstance(row, dict) for row in table['tableData']):
+                raise ValueError(f'Table {position} has rows that are not objects')
+
+    def put(self, source, doc, if_match=None, if_none_match=None):
+        """Replace a whole file. Returns ``(status, etag_or_error)``;
+        raises ValueError for a body that isn't a tables file."""
+        self.validate(doc)
+        with self._cond:
+            source, entry = self._entry(source)
+            if entry is None:
+                if if_match:
+                    return 412, 'File does not exist'
+                entry = {'path': self.path_for(source)[1], 'etag': '"new"', 'mtime_ns': None, 'size': None,
+                         'dirty_since': None, 'last_change': None, 'writing': False}
+                status = 201
+            else:
+                if if_none_match and if_none_match.strip() == '*':
+                    return 412, 'File already exists'
+                if not if_match:
+                    return 428, 'If-Match with the current ETag is required to overwrite a file'
+                if not etag_matches(if_match, entry['etag']):
+                    return 412, 'File changed since it was loaded'
+                status = 200
+            return status, self._commit(source, entry, doc, json.dumps(doc, sort_keys=True).encode('utf-8'))
+
+    def patch(self, source, operations, if_match, rows=None):
+        """Apply JSON Patch operations, or ``rows`` edits converted against
+        the current version. Returns ``(status, etag_or_error)``."""
+        if not if_match:
+            return 428, 'If-Match with the current ETag is required'
+        with self._cond:
+            source, entry = self._entry(source)
+            if entry is None:
+                return 404, 'File not found'
+            if not etag_matches(if_match, entry['etag']):
+                return 412, 'File changed since it was loaded'
+            if rows is not None:
+                operations = self.row_operations(entry['doc'], rows)
+            doc = apply_json_patch(entry['doc'], operations)
+            try:
+                self.validate(doc)
+            except ValueError as e:
+                raise JSONPatchError(f'Patched file would not be a tables file: {str(e)}')
+            return 200, self._commit(source, entry, doc, json.dumps(operations, sort_keys=True).encode('utf-8'))
+
+    @staticmethod
+    def row_operations(doc, updates):
+        """Turn ``[{table, floor, result}]`` row edits into JSON Patch
+        operations (tables by name or index, rows by floor)."""
+        tables, prefix = (doc['tables'], '/tables') if isinstance(doc, dict) else (doc, '')
+        operations = []
+        for update in updates:
+            wanted = update.get('table')
+            table_index = next((i for i, table in enumerate(tables)
+                                if i == wanted or str(table.get('name', '')).lower() == str(wanted).lower()), None)
+            if table_index is None:
+                raise JSONPatchError(f"Unknown table '{wanted}'")
+            rows = tables[table_index].get('tableData', [])
+            row_index = next((i for i, row in enumerate(rows) if row.get('floor') == update.get('floor')), None)
+            if row_index is None:
+                raise JSONPatchError(f"Table '{wanted}' has no row with floor {update.get('floor')}")
+            for field in ('result', 'ceiling'):
+                if field in update:
+                    operations.append({'op': 'replace', 'value': update[field],
+                                       'path': f'{prefix}/{table_index}/tableData/{row_index}/{field}'})
+        return operations
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='anvil-table-writer', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due, wait = [], None
+                for source, entry in self._files.items():
+                    if entry['dirty_since'] is None:
+                        continue
+                    ready_at = min(entry['last_change'] + TABLE_WRITE_DELAY_SECONDS,
+                                   entry['dirty_since'] + TABLE_WRITE_MAX_DELAY_SECONDS)
+                    if ready_at <= now:
+                        due.append(source)
+                    else:
+                        wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                if not due:
+                    self._cond.wait(timeout=wait)
+                    continue
+            for source in due:
+                try:
+                    self.flush(source)
+                except Exception as e:
+                    # Never let one bad file stop the writer for every other file
+                    log.error('table_flush_failed', source=source, error=str(e))
+
+    def flush(self, source=None):
+        """Write dirty files now (all, or just ``source``). Returns how many were written."""
+        written = 0
+        with self._write_lock:
+            with self._cond:
+                sources = [source] if source else list(self._files)
+                snapshots = []
+                for name in sources:
+                    entry = self._files.get(name)
+                    if entry and entry['dirty_since'] is not None:
+                        snapshots.append((name, entry, entry['doc'], entry['etag']))
+                        entry['dirty_since'] = None
+                        entry['writing'] = True
+            for name, entry, doc, etag in snapshots:
+                try:
+                    stat = self._write(entry['path'], doc)
+                except OSError as e:
+                    log.error('table_write_failed', source=name, error=str(e))
+                    with self._cond:
+                        entry['writing'] = False
+                        if entry['dirty_since'] is None:
+                            entry['dirty_since'] = entry['last_change'] = time.monotonic()
+                    continue
+                written += 1
+                with self._cond:
+                    entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+                    entry['writing'] = False
+                    self.writes += 1
+                try:
+                    corpus_index.index_file(entry['path'], str(entry['path'].relative_to(self.directory)))
+                except (OSError, ValueError, AttributeError, TypeError) as e:
+                    log.warning('corpus_index_failed', path=str(entry['path']), error=str(e))
+                log.info('table_file_written', source=name, bytes=stat.st_size, etag=etag)
+        return written
+
+    @staticmethod
+    def _write(path, doc):
+        # Same layout as the checked-in files (2-space indent, raw UTF-8), so diffs stay row-sized
+        data = json.dumps(doc, indent=2, ensure_ascii=False).encode('utf-8')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        try:
+            dir_fd = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass  # directories can't be fsynced on Windows
+        return path.stat()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'loaded': len(self._files),
+                'pending_writes': sum(1 for entry in self._files.values() if entry['dirty_since'] is not None),
+                'writes': self.writes,
+                'coalesced_edits': self.coalesced,
+            }
+
+
+table_files = TableFileStore(CORPUS_DIR)
+
+
+class PooledHTTPServer(socketserver.TCPServer):
+    """TCPServer that hands accepted connections to a fixed pool of worker
+    threads. When the backlog of waiting connections reaches
+    ``max_queue_depth`` new connections get an immediate 503 instead of
+    queueing behind slow upstream calls."""
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, max_workers=MAX_WORKERS,
+                 max_queue_depth=MAX_QUEUE_DEPTH):
+        super().__init__(server_address, handler_class)
+        self._pending = queue.Queue(maxsize=max_queue_depth)
+        metrics.gauge('anvil_queue_depth', self.queue_depth, 'Accepted connections waiting for a worker')
+        self._workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f'anvil-worker-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            self._reject(request)
+
+    def _worker_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def _reject(self, request):
+        metrics.inc('anvil_queue_rejected_total', help_text='Connections turned away because the worker queue was full')
+        body = json.dumps({'error': 'Server is busy, please retry shortly.'}).encode('utf-8')
+        head = (
+            'HTTP/1.0 503 Service Unavailable\r\n'
+            f'Retry-After: {RETRY_AFTER_SECONDS}\r\n'
+            'Access-Control-Allow-Origin: *\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'
+        ).encode('ascii')
+        try:
+            request.sendall(head + body)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def queue_depth(self):
+        return self._pending.qsize()
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._pending.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+
 
 class AnvilLoomHandler(http.server.SimpleHTTPRequestHandler):
+    extensions_map = {
+        **http.server.SimpleHTTPRequestHandler.extensions_map,
+        '.wasm': 'application/wasm',
+        '.mjs': 'application/javascript',
+        '.webp': 'image/webp',
+        '.md': 'text/markdown',
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=os.getcwd(), **kwargs)
     
+    GET_ROUTES = {
+        '/api/stats': 'handle_stats_api',
+        '/api/metrics': 'handle_metrics_api',
+        '/api/roll': 'handle_roll_api',
+        '/api/tables': 'handle_tables_api',
+        '/api/search': 'handle_search_api',
+        '/api/jobs': 'handle_jobs_api',
+        '/api/table-files': 'handle_table_files_api',
+    }
+    POST_ROUTES = {
+        '/api/chat': 'handle_chat_api',
+        '/api/batch-generate': 'handle_batch_generate_api',
+        '/api/openai': 'handle_openai_api',
+        '/api/generate-file': 'handle_generate_file_api',
+        '/api/batch-review': 'handle_batch_review_api',
+        '/api/roll': 'handle_roll_api',
+        '/api/jobs': 'handle_jobs_api',
+    }
+    # PUT and PATCH share one table
+    WRITE_ROUTES = {
+        '/api/table-files': 'handle_table_files_api',
+    }
+    # Routes that also own every path below them, e.g. /api/jobs/<id>
+    PREFIX_ROUTES = ('/api/jobs', '/api/table-files')
+
+    def handle_one_request(self):
+        # Instrumentation hook: times every request from parse to last byte
+        self._status = None
+        start = time.perf_counter()
+        super().handle_one_request()
+        if self._status is None or not getattr(self, 'command', None):
+            return
+        endpoint = self.metrics_endpoint()
+        metrics.inc('anvil_http_requests_total',
+                    {'endpoint': endpoint, 'method': self.command, 'status': str(self._status)},
+                    help_text='HTTP requests by endpoint, method and status')
+        metrics.observe('anvil_http_request_duration_seconds', time.perf_counter() - start, {'endpoint': endpoint},
+                        help_text='Time spent handling HTTP requests, including upstream calls')
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def log_message(self, format, *args):
+        # Access log goes through the background writer instead of blocking on stderr
+        log.debug('http_access', client=self.address_string(), message=format % args)
+
+    def log_error(self, format, *args):
+        log.warning('http_error', client=self.address_string(), message=format % args)
+
+    def route_path(self):
+        path = urllib.parse.urlsplit(self.path).path
+        for prefix in self.PREFIX_ROUTES:
+            if path.startswith(prefix + '/'):
+                return prefix
+        return path
+
+    def metrics_endpoint(self):
+        path = self.route_path()
+        if path in self.GET_ROUTES or path in self.POST_ROUTES or path in self.WRITE_ROUTES:
+            return path
+        return 'other' if path.startswith('/api/') else 'static'
+
     def do_GET(self):
-        if self.path == '/' or self.path == '/index.html':
-            self.serve_index_html()
-        else:
-            super().do_GET()
+        path = self.route_path()
+        handler = self.GET_ROUTES.get(path)
+        if handler is None:
+            self.serve_static()
+            return
+
+        if not endpoint_limiter.acquire(path):
+            self.send_busy()
+            return
+        try:
+            getattr(self, handler)()
+        finally:
+            endpoint_limiter.release(path)
+
+    def do_HEAD(self):
+        self.serve_static(head_only=True)
     
     def do_POST(self):
-        if self.path == '/api/chat':
-            self.handle_chat_api()
-        elif self.path == '/api/batch-generate':
-            self.handle_batch_generate_api()
-        elif self.path == '/api/openai':
-            self.handle_openai_api()
-        else:
+        self.dispatch_api(self.POST_ROUTES)
+
+    def do_PUT(self):
+        self.dispatch_api(self.WRITE_ROUTES)
+
+    def do_PATCH(self):
+        self.dispatch_api(self.WRITE_ROUTES)
+
+    def dispatch_api(self, routes):
+        path = self.route_path()
+        handler = routes.get(path)
+        if handler is None:
             self.send_error(404, "API endpoint not found")
+            return
+
+        if not endpoint_limiter.acquire(path):
+            self.send_busy()
+            return
+        try:
+            getattr(self, handler)()
+        finally:
+            endpoint_limiter.release(path)
     
     def do_OPTIONS(self):
         # Handle CORS preflight requests
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-API-Key, X-API-Key-Encoded')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', CORS_ALLOW_HEADERS)
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
         self.end_headers()
     
-    def serve_index_html(self):
+    def send_busy(self):
+        body = json.dumps({'error': f'Too many concurrent {self.path} requests, please retry shortly.'}).encode('utf-8')
+        self.send_response(503)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Retry-After', str(RETRY_AFTER_SECONDS))
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_static(self, head_only=False):
+        # Dot directories hold the caches and job database (.cache), not assets
+        segments = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).split('/')
+        if any(segment.startswith('.') for segment in segments):
+            self.send_error(404, "File not found")
+            return
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            index_path = os.path.join(path, 'index.html')
+            if not self.path.split('?', 1)[0].endswith('/') or not os.path.isfile(index_path):
+                # Let SimpleHTTPRequestHandler handle redirects and directory listings
+                return super().do_HEAD() if head_only else super().do_GET()
+            path = index_path
         try:
-            with open('index.html', 'r', encoding='utf-8') as f:
-                content = f.read()
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.send_header('Content-Length', str(len(content.encode('utf-8'))))
+            stat = os.stat(path)
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+
+        cached = static_cache.get(path, stat)
+        etag = cached['etag'] if cached else f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        content_type = self.guess_type(path)
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        is_html = path.endswith(('.html', '.htm'))
+
+        def send_common_headers(status):
+            self.send_response(status)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+            self.send_header('Cache-Control', 'no-cache' if is_html else f'public, max-age={STATIC_MAX_AGE_SECONDS}')
+            if cached:
+                self.send_header('Vary', 'Accept-Encoding')
+            else:
+                self.send_header('Accept-Ranges', 'bytes')
+
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            send_common_headers(304)
             self.end_headers()
-            self.wfile.write(content.encode('utf-8'))
-        except FileNotFoundError:
-            self.send_error(404, "index.html not found")
-    
-    def handle_chat_api(self):
+            return
+
+        if cached:
+            encodings = accepted_encodings(self.headers.get('Accept-Encoding'))
+            encoding = next((e for e in ('br', 'gzip') if e in encodings and e in cached['variants']), 'identity')
+            body = cached['variants'][encoding]
+            send_common_headers(200)
+            self.send_header('Content-type', content_type)
+            if encoding != 'identity':
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head_only:
+                self.wfile.write(body)
+            return
+
+        self.serve_file_range(path, stat, content_type, send_common_headers, etag, head_only)
+
+    def serve_file_range(self, path, stat, content_type, send_common_headers, etag, head_only):
+        size = stat.st_size
+        byte_range = None
+        if_range = self.headers.get('If-Range')
+        if not if_range or if_range.strip() == etag:
+            byte_range = parse_byte_range(self.headers.get('Range'), size)
+        if byte_range == 'unsatisfiable':
+            send_common_headers(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if byte_range:
+            start, end = byte_range
+            send_common_headers(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            start, end = 0, size - 1
+            send_common_headers(200)
+        length = end - start + 1 if size else 0
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        if head_only or not length:
+            return
+
+        with open(path, 'rb') as f:
+            self.wfile.flush()
+            # socket.sendfile uses zero-copy os.sendfile where the platform supports it
+            self.connection.sendfile(f, offset=start, count=length)
+
+    def read_json_body(self):
+        content_length = int(self.headers['Content-Length'])
+        post_data = self.rfile.read(content_length)
+        if self.headers.get('Content-Encoding', '').strip().lower() == 'gzip':
+            # Bounded inflate, so a small gzip bomb can't balloon in memory
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            post_data = inflater.decompress(post_data, MAX_REQUEST_BODY_BYTES)
+            if inflater.unconsumed_tail:
+                raise ValueError(f'Request body exceeds {MAX_REQUEST_BODY_BYTES} bytes once decompressed')
+        return json.loads(post_data.decode('utf-8'))
+
+    def read_api_key(self):
+        # Handle both encoded and regular API keys
+        encoded_key = self.headers.get('X-API-Key-Encoded')
+        if encoded_key:
+            return base64.b64decode(encoded_key).decode('utf-8')
+        return self.headers.get('X-API-Key')
+
+    def proxy_chat_completion(self):
         # Add CORS headers
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -66,390 +3768,429 @@ class AnvilLoomHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         
         try:
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
+            request_data = self.read_json_body()
             
-            # Get API key from headers
-            api_key = self.headers.get('X-API-Key')
+            api_key = self.read_api_key()
             if not api_key:
                 self.wfile.write(json.dumps({
                     'error': 'API key required. Set X-API-Key header.'
                 }).encode('utf-8'))
                 return
             
-            # Prepare OpenAI API request
-            openai_url = 'https://api.openai.com/v1/chat/completions'
-            
-            # Forward the request to OpenAI
-            openai_request = urllib.request.Request(
-                openai_url,
-                data=json.dumps(request_data).encode('utf-8'),
-                headers={
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                }
-            )
-            
-            with urllib.request.urlopen(openai_request) as response:
-                response_data = response.read()
-                self.wfile.write(response_data)
+            # Forward the request to OpenAI, joining an identical call already in flight
+            if self.should_coalesce():
+                key = ResponseCache.key_for(request_data)
+                response, shared = coalescer.do(self.path, key,
+                                                lambda: upstream.chat_completion(request_data, api_key, self.upstream_priority()))
+            else:
+                response, shared = upstream.chat_completion(request_data, api_key, self.upstream_priority()), False
+            self.wfile.write(response.body)
+            if not shared:
+                try:
+                    record_usage(request_data.get('model'), request_data.get('table_type'), response.json().get('usage'))
+                except (ValueError, AttributeError):
+                    pass
                 
         except Exception as e:
             error_response = {
                 'error': f'API request failed: {str(e)}'
             }
             self.wfile.write(json.dumps(error_response).encode('utf-8'))
+
+    def handle_chat_api(self):
+        self.proxy_chat_completion()
     
+    def wants_fresh_response(self):
+        # Per-request cache bypass for when we deliberately want new variety
+        if self.headers.get('X-Cache-Bypass', '').lower() in ('1', 'true', 'yes'):
+            return True
+        return 'no-cache' in self.headers.get('Cache-Control', '').lower()
+
+    def upstream_priority(self):
+        return ENDPOINT_PRIORITY.get(self.path, PRIORITY_STANDARD)
+
+    def should_coalesce(self):
+        return COALESCE_ENDPOINTS.get(self.path, False) and not self.wants_fresh_response()
+
+    def wants_stream(self, data):
+        return bool(data.get('stream')) or 'text/event-stream' in self.headers.get('Accept', '')
+
     def handle_batch_generate_api(self):
+        cache_status = None
+        try:
+            data = self.read_json_body()
+            
+            api_key = self.read_api_key()
+            if not api_key:
+                result = {'error': 'API key required'}
+            elif data.get('async'):
+                self.send_job(job_queue.submit('batch-generate', data, api_key, not self.wants_fresh_response()))
+                return
+            elif self.wants_stream(data):
+                self.stream_batch_generate(data, api_key)
+                return
+            else:
+                result, cache_status = run_batch_generation(data, api_key, use_cache=not self.wants_fresh_response(),
+                                                            coalesce=self.should_coalesce(),
+                                                            priority=self.upstream_priority())
+        except Exception as e:
+            result = {
+                'error': f'Batch generation failed: {str(e)}'
+            }
+            log.error('batch_generation_failed', error=str(e))
+
+        body = json.dumps(result).encode('utf-8')
         # Add CORS headers
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-API-Key, X-API-Key-Encoded')
+        self.send_header('Access-Control-Allow-Headers', CORS_ALLOW_HEADERS)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if cache_status:
+            self.send_header('X-Cache', cache_status)
         self.end_headers()
-        
+        self.wfile.write(body)
+
+    def stream_batch_generate(self, data, api_key):
+        # Server-Sent Events: one "entry" event per parsed result, then "done"
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+
+        def emit(event, payload):
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
         try:
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
-            
-            # Handle both encoded and regular API keys
-            encoded_key = self.headers.get('X-API-Key-Encoded')
-            regular_key = self.headers.get('X-API-Key')
-            
-            if encoded_key:
-                api_key = base64.b64decode(encoded_key).decode('utf-8')
-            elif regular_key:
-                api_key = regular_key
-            else:
-                self.wfile.write(json.dumps({
-                    'error': 'API key required'
-                }).encode('utf-8'))
-                return
+            stream_batch_generation(data, api_key, emit, use_cache=not self.wants_fresh_response(),
+                                    priority=self.upstream_priority())
+        except (BrokenPipeError, ConnectionResetError):
+            log.info('stream_client_disconnected', path=self.path)
+        except Exception as e:
+            log.error('batch_generation_failed', error=str(e), stream=True)
+            try:
+                emit('error', {'error': f'Batch generation failed: {str(e)}'})
+            except OSError:
+                pass
 
-            table_type = data.get('table_type')
-            table_name = data.get('table_name')
-            model = data.get('model', 'gpt-3.5-turbo')
-            domain_context = data.get('domain_context')
-            num_entries = data.get('num_entries', 10)
-            genre = data.get('genre', 'dark-fantasy')
-
-            # Build context for batch generation
-            context_name = domain_context.get('name', 'Unknown') if domain_context else 'Unknown'
-            context_type = domain_context.get('type', 'concept') if domain_context else 'concept'
-            context_description = domain_context.get('description', '') if domain_context else ''
+    def handle_generate_file_api(self):
+        try:
+            data = self.read_json_body()
             
-            # Genre-specific styles
-            genre_styles = {
-                'dark-fantasy': {
-                    'tone': 'Grim, morally complex, visceral',
-                    'inspiration': 'Joe Abercrombie style - harsh realism, flawed characters, bitter consequences'
-                },
-                'fantasy': {
-                    'tone': 'Epic, heroic, wonder-filled',
-                    'inspiration': 'Margaret Weis & Tracy Hickman style - grand quests, noble heroes, magical wonder'
-                },
-                'sci-fi': {
-                    'tone': 'Technological, political, realistic', 
-                    'inspiration': 'James S.A. Corey style - hard science, political intrigue, human struggle'
-                },
-                'starforged': {
-                    'tone': 'Swashbuckling, maritime adventure, mystical',
-                    'inspiration': 'R.A. Salvatore style - heroic adventure, nautical themes, ancient mysteries'
-                }
+            api_key = self.read_api_key()
+            if not api_key:
+                result = {'error': 'API key required'}
+            elif data.get('async'):
+                self.send_job(job_queue.submit('generate-file', data, api_key, not self.wants_fresh_response()))
+                return
+            else:
+                max_concurrency = int(data.get('max_concurrency', FANOUT_CONCURRENCY))
+                result = generate_file(data, api_key, use_cache=not self.wants_fresh_response(),
+                                       max_concurrency=min(max_concurrency, FANOUT_CONCURRENCY),
+                                       coalesce=self.should_coalesce(),
+                                       priority=self.upstream_priority())
+        except Exception as e:
+            result = {
+                'error': f'File generation failed: {str(e)}'
             }
+            log.error('file_generation_failed', error=str(e))
+        self.send_json(result)
+
+    def handle_batch_review_api(self):
+        try:
+            data = self.read_json_body()
             
-            current_genre = genre_styles.get(genre, genre_styles['dark-fantasy'])
-
-            # Table type rules with contextual generation
-            table_rules = {
-                'objective': {
-                    'word_count': '6-10 words',
-                    'focus': 'Thematic obstacles, challenges, puzzles, goals, or tasks that need to be accomplished',
-                    'style': 'Clear objectives that players must overcome or achieve to succeed or prevent negative outcomes'
-                },
-                'atmosphere': {
-                    'word_count': '4-10 words', 
-                    'focus': 'Sensory experiences, emotional feelings, or intuitive impressions that set the mood',
-                    'style': 'Evocative phrases capturing any sense (sight, sound, smell, touch, taste) or emotional/intuitive feelings'
-                },
-                'manifestation': {
-                    'word_count': '4-10 words',
-                    'focus': 'Tangible expressions of abstract themes that players can interact with',
-                    'style': 'Physical, observable phenomena that bring thematic elements to life'
-                },
-                'location': {
-                    'word_count': '4-10 words',
-                    'focus': 'Context-appropriate locations: For buildings/structures, generate ROOMS (throne room, dungeon cell, armory). For natural/exploration domains, generate AREAS or FEATURES (hidden grove, ancient cairn, frozen lake). Consider what explorers would encounter.',
-                    'style': 'Buildings: interior rooms and chambers. Wilderness: geographical features, landmarks, and exploration sites. Settlements: districts, buildings, gathering places.'
-                },
-                'discovery': {
-                    'word_count': '4-10 words',
-                    'focus': 'Context-specific discoveries fitting the domain/aspect: Ancient places yield historical artifacts, forgotten knowledge, relics. Natural areas contain rare materials, hidden paths, wildlife signs. Structures hold secret passages, hidden chambers, forgotten items. Mystical domains reveal magical phenomena, enchanted objects. Match discoveries to what would realistically be found in this specific environment.',
-                    'style': 'Treasures, secrets, lore, clues, artifacts, or phenomena that reward exploration and deepen understanding of this particular place or theme'
-                },
-                'bane': {
-                    'word_count': '4-10 words',
-                    'focus': 'Negative influences or obstacles that create challenges',
-                    'style': 'Threatening elements that add tension and conflict to scenes'
-                },
-                'boon': {
-                    'word_count': '4-10 words',
-                    'focus': 'Positive influences or advantages that aid characters',
-                    'style': 'Beneficial elements that provide assistance or opportunities'
-                }
+            api_key = self.read_api_key()
+            if not api_key:
+                result = {'error': 'API key required'}
+            elif data.get('async'):
+                self.send_job(job_queue.submit('batch-review', data, api_key))
+                return
+            else:
+                result = review_table(data, api_key, priority=self.upstream_priority())
+        except Exception as e:
+            result = {
+                'error': f'Batch review failed: {str(e)}'
             }
-            
-            current_rules = table_rules.get(table_type, table_rules['atmosphere'])
-            
-            # Build context information
-            context_info = f"""
-🎯 PRIMARY THEME: This is the {context_type.upper()} '{context_name}' - the CORE CONCEPT that defines everything.
-DESCRIPTION: {context_description}
+            log.error('batch_review_failed', error=str(e))
+        self.send_json(result)
 
-CRITICAL: Every single piece of content must directly derive from and embody the essence of '{context_name}'. This {context_type} is the foundational theme that gives meaning to all elements.
-
-The {context_type} name '{context_name}' is not just flavor text - it is the generative source of all content."""
+    def send_job(self, job):
+        if 'error' in job:
+            self.send_json(job)
+            return
+        job['status_url'] = f"/api/jobs/{job['id']}"
+        self.send_json(job, status=202)
 
-            # Create system prompt
-            system_prompt = f"""You are a creative writing assistant specializing in tabletop RPG content generation. You create evocative, thematic content for ForgeTable random tables.
+    def handle_jobs_api(self):
+        # GET /api/jobs, GET /api/jobs/<id>, POST /api/jobs,
+        # POST /api/jobs/<id>/resume, POST /api/jobs/<id>/cancel
+        parts = [part for part in urllib.parse.urlsplit(self.path).path.split('/')[3:] if part]
+        try:
+            if self.command == 'GET':
+                if not parts:
+                    self.send_json({'jobs': job_queue.list(), 'counts': job_queue.stats()})
+                    return
+                job = job_queue.get(parts[0])
+            elif not parts:
+                data = self.read_json_body()
+                api_key = self.read_api_key()
+                if not api_key:
+                    self.send_json({'error': 'API key required'})
+                    return
+                request = data.get('request') or {key: value for key, value in data.items() if key != 'kind'}
+                self.send_job(job_queue.submit(data.get('kind'), request, api_key, not self.wants_fresh_response()))
+                return
+            elif len(parts) == 2 and parts[1] == 'resume':
+                job = job_queue.resume(parts[0], self.read_api_key())
+            elif len(parts) == 2 and parts[1] == 'cancel':
+                job = job_queue.cancel(parts[0])
+            else:
+                self.send_error(404, "API endpoint not found")
+                return
+        except (sqlite3.Error, ValueError, KeyError) as e:
+            job = {'error': f'Job request failed: {str(e)}'}
+        if job is None:
+            self.send_json({'error': f"Unknown job '{parts[0]}'"}, status=404)
+        else:
+            self.send_json(job)
 
-WRITING REQUIREMENTS:
-- Target 9th grade reading level while maintaining creativity and style
-- Write in {current_genre['tone']} style
-- Inspired by {current_genre['inspiration']}
-- Each entry should be {current_rules['word_count']} words
-- Focus: {current_rules['focus']}
-- Style: {current_rules['style']}
+    def handle_stats_api(self):
+        self.send_json({
+            'coalescing': coalescer.stats(),
+            'response_cache': batch_cache.stats(),
+            'scheduler': upstream.scheduler.stats(),
+            'corpus_index': corpus_index.stats(),
+            'table_corpus': table_corpus.stats(),
+            'jobs': job_queue.stats(),
+            'table_files': table_files.stats(),
+            'log': {'level': LOG_LEVEL, 'queued': log._queue.qsize(), 'dropped': log.dropped},
+        })
 
-{context_info}
+    def handle_metrics_api(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        wants_json = query.get('format', [''])[0] == 'json' or 'application/json' in self.headers.get('Accept', '')
+        if wants_json:
+            self.send_json(metrics.as_json())
+            return
+        body = metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-ANTI-REPETITION RULES:
-- Never repeat the same opening words across entries
-- Vary sentence structure and phrasing dramatically
-- Avoid formulaic patterns or templates
-- Each entry must feel unique and distinct
+    def handle_roll_api(self):
+        try:
+            if self.command == 'POST':
+                data = self.read_json_body()
+            else:
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+                data = {key: values[0] for key, values in query.items()}
+            if not data.get('table'):
+                result = {'error': 'table is required', 'tables': roll_engine.tables()}
+            else:
+                flag = lambda value: str(value).lower() in ('1', 'true', 'yes')
+                result = roll_engine.roll(
+                    data['table'],
+                    count=int(data.get('count', 1)),
+                    seed=int(data['seed']) if data.get('seed') is not None else None,
+                    resolve_macros=flag(data.get('resolve_macros', True)),
+                    max_depth=int(data.get('max_depth', ROLL_MAX_MACRO_DEPTH)),
+                    detailed=flag(data['detailed']) if 'detailed' in data else None,
+                )
+        except (ValueError, TypeError) as e:
+            result = {'error': f'Invalid roll request: {str(e)}'}
+        self.send_json(result)
 
-Generate EXACTLY {num_entries} creative entries that embody the essence of '{context_name}'. 
+    def query_params(self):
+        return urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
 
-CRITICAL: Return ONLY a valid JSON array of strings, nothing else. No explanations, no markdown, no additional text - just the JSON array.
+    def handle_tables_api(self):
+        query = self.query_params()
+        try:
+            if query.get('id'):
+                table = table_corpus.get_table(query['id'][0])
+                result = table if table is not None else {'error': f"Unknown table '{query['id'][0]}'"}
+            else:
+                tables = table_corpus.list_tables(category=query.get('category', [None])[0],
+                                                  tags=query.get('tag', []),
+                                                  source=query.get('source', [None])[0])
+                result = {'tables': tables, 'count': len(tables)}
+        except sqlite3.Error as e:
+            result = {'error': f'Table corpus unavailable: {str(e)}'}
+        self.send_json(result)
 
-Example format: ["Entry 1", "Entry 2", "Entry 3"]"""
+    def handle_search_api(self):
+        query = self.query_params()
+        text = query.get('q', [''])[0]
+        if not text.strip():
+            self.send_json({'error': 'q is required'})
+            return
+        start = time.perf_counter()
+        try:
+            hits = table_corpus.search(text, category=query.get('category', [None])[0], tags=query.get('tag', []),
+                                       source=query.get('source', [None])[0],
+                                       limit=query.get('limit', ['20'])[0])
+            result = {'query': text, 'results': hits, 'count': len(hits),
+                      'took_ms': round((time.perf_counter() - start) * 1000, 2)}
+        except (sqlite3.Error, ValueError) as e:
+            result = {'error': f'Search failed: {str(e)}'}
+        self.send_json(result)
 
-            # Create OpenAI request with model-specific parameters
-            openai_request = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Generate {num_entries} {table_type} entries for the {context_type} '{context_name}'."}
-                ]
-            }
-            
-            # Add model-specific parameters
-            if model == "gpt-5":
-                # GPT-5 uses max_completion_tokens, reasoning_effort, and default temperature (1)
-                # Give more tokens and minimal reasoning to ensure actual content generation
-                openai_request["max_completion_tokens"] = 3000
-                openai_request["reasoning_effort"] = "minimal"
-                # Temperature defaults to 1 for GPT-5, don't set it
+    def handle_table_files_api(self):
+        # GET /api/table-files                  list files
+        # GET /api/table-files/<source>         whole file, with ETag (gzip if accepted)
+        # PUT /api/table-files/<source>         replace or create (If-Match / If-None-Match: *)
+        # PATCH /api/table-files/<source>       JSON Patch, or {"rows": [{table, floor, result}]}
+        # ?sync=1 on PUT/PATCH writes through instead of waiting for the write-behind flush
+        source = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path[len('/api/table-files'):]).strip('/')
+        if not source:
+            if self.command == 'GET':
+                self.send_json({'files': table_files.list(), 'stats': table_files.stats()})
             else:
-                # All other models use max_tokens and can set temperature
-                openai_request["max_tokens"] = 2000
-                openai_request["temperature"] = 0.9
-
-            # Call OpenAI API
-            openai_url = 'https://api.openai.com/v1/chat/completions'
-            
-            print(f"\n=== OpenAI API Request ===")
-            print(f"Model: {model}")
-            print(f"Table Type: {table_type}")
-            print(f"Num Entries: {num_entries}")
-            print(f"Context: {context_name} ({context_type})")
-            print(f"Request payload:")
-            print(json.dumps(openai_request, indent=2))
-            
-            openai_req = urllib.request.Request(
-                openai_url,
-                data=json.dumps(openai_request).encode('utf-8'),
-                headers={
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                }
-            )
-            
-            with urllib.request.urlopen(openai_req) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                
-                # Debug: log the response structure
-                print(f"OpenAI API Response: {json.dumps(response_data, indent=2)}")
-                
-                if 'error' in response_data:
-                    error_details = response_data['error']
-                    error_msg = f"OpenAI API error {response.status}: {error_details.get('message', 'Unknown error')}"
-                    print(f"API Error: {error_msg}")
-                    self.wfile.write(json.dumps({
-                        'error': error_msg,
-                        'details': error_details
-                    }).encode('utf-8'))
-                    return
-                
-                if 'choices' in response_data and len(response_data['choices']) > 0:
-                    choice = response_data['choices'][0]
-                    content = choice['message']['content'].strip()
-                    finish_reason = choice.get('finish_reason', 'unknown')
-                    
-                    print(f"Raw AI Generated Content: '{content}'")
-                    print(f"Finish reason: {finish_reason}")
-                    
-                    # Check if we got an empty response due to token limits
-                    if not content and finish_reason == 'length':
-                        print("GPT-5 used all tokens for reasoning, no content generated")
-                        self.wfile.write(json.dumps({
-                            'error': 'GPT-5 used all tokens for reasoning. Try reducing reasoning_effort or increasing max_completion_tokens.',
-                            'details': {'finish_reason': finish_reason, 'usage': response_data.get('usage', {})}
-                        }).encode('utf-8'))
-                        return
-                    
-                    # Clean up the content for JSON parsing
-                    cleaned_content = content
-                    if cleaned_content.startswith('```json'):
-                        cleaned_content = cleaned_content[7:]
-                    if cleaned_content.startswith('```'):
-                        cleaned_content = cleaned_content[3:]
-                    if cleaned_content.endswith('```'):
-                        cleaned_content = cleaned_content[:-3]
-                    cleaned_content = cleaned_content.strip()
-                    print(f"Cleaned Content: '{cleaned_content}'")
-                    
-                    try:
-                        # Parse JSON response using cleaned content
-                        results = json.loads(cleaned_content)
-                        if isinstance(results, list):
-                            # Truncate to requested number if AI returned more
-                            results = results[:num_entries]
-                            print(f"Successfully parsed {len(results)} results")
-                            self.wfile.write(json.dumps({'results': results}).encode('utf-8'))
-                        else:
-                            raise ValueError("Expected array response")
-                    except (json.JSONDecodeError, ValueError) as e:
-                        print(f"JSON parse failed: {e}")
-                        print(f"Failed content: {cleaned_content}")
-                        
-                        # Try to extract JSON array from the response
-                        import re
-                        json_match = re.search(r'\[.*?\]', cleaned_content, re.DOTALL)
-                        if json_match:
-                            try:
-                                extracted_json = json_match.group(0)
-                                print(f"Extracted JSON: {extracted_json}")
-                                results = json.loads(extracted_json)
-                                if isinstance(results, list):
-                                    results = results[:num_entries]
-                                    print(f"Successfully parsed extracted JSON with {len(results)} results")
-                                    self.wfile.write(json.dumps({'results': results}).encode('utf-8'))
-                                    return
-                            except json.JSONDecodeError:
-                                print("Extracted JSON also failed to parse")
-                        
-                        # Final fallback: split by lines and clean up
-                        lines = [line.strip().strip('"-,') for line in cleaned_content.split('\n') if line.strip()]
-                        results = [line for line in lines if line and not line.startswith('[') and not line.startswith(']') and not line.startswith('{')][:num_entries]
-                        print(f"Fallback parsing yielded {len(results)} results: {results}")
-                        if results:
-                            self.wfile.write(json.dumps({'results': results}).encode('utf-8'))
-                        else:
-                            self.wfile.write(json.dumps({'error': f'Could not parse AI response: {cleaned_content[:500]}...'}).encode('utf-8'))
+                self.send_json({'error': 'A table file path is required'}, status=400)
+            return
+        try:
+            table_files.path_for(source)
+            if self.command == 'GET':
+                self.send_table_file(source)
+                return
+            data = self.read_json_body()
+            if self.command == 'PUT':
+                status, outcome = table_files.put(source, data, if_match=self.headers.get('If-Match'),
+                                                  if_none_match=self.headers.get('If-None-Match'))
+            else:
+                content_type = self.headers.get('Content-Type', '')
+                if isinstance(data, list) or 'json-patch' in content_type:
+                    operations, rows = data, None
+                elif isinstance(data, dict) and isinstance(data.get('rows'), list):
+                    operations, rows = None, data['rows']
                 else:
-                    print(f"No choices in response: {response_data}")
-                    self.wfile.write(json.dumps({'error': 'No response from OpenAI'}).encode('utf-8'))
-                    
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode('utf-8') if e.fp else 'No error details'
-            try:
-                error_json = json.loads(error_body)
-                error_response = {
-                    'error': f'OpenAI API error: {e.code}',
-                    'details': error_json
-                }
-                print(f"OpenAI API error {e.code}: {error_json}")
-            except json.JSONDecodeError:
-                error_response = {
-                    'error': f'OpenAI API error: {e.code}',
-                    'details': {'message': error_body}
-                }
-                print(f"OpenAI API error {e.code}: {error_body}")
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
-        except Exception as e:
-            error_response = {
-                'error': f'Batch generation failed: {str(e)}'
-            }
-            print(f"Batch generation error: {str(e)}")
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+                    self.send_json({'error': 'Expected a JSON Patch array or {"rows": [...]}'}, status=415)
+                    return
+                status, outcome = table_files.patch(source, operations, self.headers.get('If-Match'), rows=rows)
+        except JSONPatchError as e:
+            self.send_json({'error': f'Patch failed: {str(e)}'}, status=409)
+            return
+        except (ValueError, TypeError, KeyError, zlib.error) as e:
+            self.send_json({'error': f'Invalid table file request: {str(e)}'}, status=400)
+            return
+        if status >= 400:
+            _, etag = table_files.get(source)
+            self.send_json({'error': outcome, 'etag': etag}, status=status)
+            return
+        flag = self.query_params().get('sync', [''])[0].lower() in ('1', 'true', 'yes')
+        written = table_files.flush(source) if flag else 0
+        # Reply with the new version only; the client already holds the document
+        body = json.dumps({'source': source, 'etag': outcome, 'written': bool(written)}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        self.send_header('ETag', outcome)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    def handle_openai_api(self):
-        # Add CORS headers  
+    def send_table_file(self, source):
+        doc, etag = table_files.get(source)
+        if doc is None:
+            self.send_json({'error': f"Unknown table file '{source}'"}, status=404)
+            return
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = json.dumps(doc, ensure_ascii=False).encode('utf-8')
+        encoding = 'gzip' if 'gzip' in accepted_encodings(self.headers.get('Accept-Encoding')) else None
+        if encoding:
+            body = gzip.compress(body, compresslevel=6, mtime=0)
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, result, status=200):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        
-        try:
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # Get API key from headers
-            api_key = self.headers.get('X-API-Key')
-            if not api_key:
-                self.wfile.write(json.dumps({
-                    'error': 'API key required. Set X-API-Key header.'
-                }).encode('utf-8'))
-                return
-            
-            # Forward request to OpenAI
-            openai_url = 'https://api.openai.com/v1/chat/completions'
-            openai_request = urllib.request.Request(
-                openai_url,
-                data=json.dumps(request_data).encode('utf-8'),
-                headers={
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                }
-            )
-            
-            with urllib.request.urlopen(openai_request) as response:
-                response_data = response.read()
-                self.wfile.write(response_data)
-                
-        except Exception as e:
-            error_response = {
-                'error': f'API request failed: {str(e)}'
-            }
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+        self.wfile.write(body)
+
+    def handle_openai_api(self):
+        self.proxy_chat_completion()
 
 def main():
     print(f"Starting Anvil & Loom JSON Explorer on http://{HOST}:{PORT}")
     print("Available endpoints:")
     print(f"  - http://{HOST}:{PORT}/ (main app)")
-    print(f"  - http://{HOST}:{PORT}/api/batch-generate (AI generation)")
+    print(f"  - http://{HOST}:{PORT}/api/batch-generate (AI generation; \"stream\": true for SSE)")
+    print(f"  - http://{HOST}:{PORT}/api/generate-file (fill a whole aspect/domain file)")
+    print(f"  - http://{HOST}:{PORT}/api/batch-review (review a whole table)")
+    print(f"  - http://{HOST}:{PORT}/api/roll (roll a table; bulk histograms)")
+    print(f"  - http://{HOST}:{PORT}/api/tables (table list; ?id= for one table, ?tag=&category= filters)")
+    print(f"  - http://{HOST}:{PORT}/api/search?q= (full-text search over tables and rows)")
+    print(f"  - http://{HOST}:{PORT}/api/jobs (background generation/review jobs; \"async\": true on those endpoints)")
+    print(f"  - http://{HOST}:{PORT}/api/table-files/<path> (load/save table files; ETag PATCH, write-behind)")
     print(f"  - http://{HOST}:{PORT}/api/chat (OpenAI chat)")
     print(f"  - http://{HOST}:{PORT}/api/openai (OpenAI proxy)")
+    print(f"  - http://{HOST}:{PORT}/api/stats (coalescing and cache counters)")
+    print(f"  - http://{HOST}:{PORT}/api/metrics (Prometheus text; ?format=json for JSON)")
     print("Make sure index.html is in the same directory as this script")
     print("Press Ctrl+C to stop the server")
+    print(f"Logging JSON lines at level '{LOG_LEVEL}' to {LOG_FILE or 'stderr'} (ANVIL_LOG_LEVEL=debug for payloads)")
     
     try:
-        with socketserver.TCPServer((HOST, PORT), AnvilLoomHandler) as httpd:
-            print(f"\n✓ Server is now running at http://{HOST}:{PORT}")
+        if SERVER_MODE == 'pooled':
+            httpd = PooledHTTPServer((HOST, PORT), AnvilLoomHandler)
+            mode_line = f"{MAX_WORKERS} workers, queue depth {MAX_QUEUE_DEPTH}"
+        else:
+            httpd = socketserver.TCPServer((HOST, PORT), AnvilLoomHandler)
+            mode_line = "single connection at a time"
+        warmed = static_cache.warm(os.getcwd())
+        print(f"✓ Precompressed {warmed} static text assets" + ("" if brotli else " (install 'brotli' for br encoding)"))
+        recovered = job_queue.start()
+        if recovered['resumed'] or recovered['paused']:
+            print(f"✓ Jobs: {recovered['resumed']} resumed, {recovered['paused']} paused awaiting an API key")
+        if CORPUS_DIR.is_dir():
+            start = time.perf_counter()
+            changed = table_corpus.sync(force=True)
+            print(f"✓ Table corpus ready in {time.perf_counter() - start:.2f}s "
+                  f"({len(changed)} files recompiled, {table_corpus.stats()['tables']} tables)")
+            print(f"✓ Compiled {roll_engine.load_directory(CORPUS_DIR)} tables for /api/roll"
+                  + (" (numpy)" if numpy is not None else " (install 'numpy' for faster bulk rolls)"))
+            # Built in the background; lookups simply see fewer entries until it finishes
+            threading.Thread(target=load_corpus_index, name='anvil-corpus-index', daemon=True).start()
+            print(f"✓ Indexing table corpus in {CORPUS_DIR} for near-duplicate filtering")
+        with httpd:
+            print(f"\n✓ Server is now running at http://{HOST}:{PORT} ({mode_line})")
             print("✓ Ready to accept requests!")
             print(f"✓ Open your browser to http://{HOST}:{PORT}")
             httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nServer stopped by user")
+        written = table_files.flush()
+        if written:
+            print(f"✓ Saved {written} pending table file(s)")
+        log.flush()
     except OSError as e:
         if e.errno == 48:  # Address already in use on Mac/Linux
             print(f"\nError: Port {PORT} is already in use.")
@@ -0,0 +1,146 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('ANVIL_LOG_LEVEL', 'error')
+os.environ.setdefault('ANVIL_CACHE_DIR', tempfile.mkdtemp(prefix='anvil-tests-'))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import standalone_server as server  # noqa: E402
+
+
+def jaccard(a, b):
+    a, b = server.NearDuplicateIndex.shingles(a), server.NearDuplicateIndex.shingles(b)
+    return len(a & b) / len(a | b)
+
+
+class NearDuplicateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = server.NearDuplicateIndex(threshold=0.6)
+        self.index.add('A lantern gutters in a draft from nowhere', 'aspects/haunted.json')
+
+    def test_identical_and_reworded_entries_match(self):
+        match = self.index.find('A lantern gutters in a draft from nowhere')
+        self.assertEqual(match['similarity'], 1.0)
+        self.assertEqual(match['source'], 'aspects/haunted.json')
+        # Case, punctuation and articles don't count
+        self.assertIsNotNone(self.index.find('The lantern gutters in the draft, from nowhere!'))
+
+    def test_unrelated_entry_does_not_match(self):
+        self.assertIsNone(self.index.find('Bones stacked neatly beside the well'))
+
+    def test_threshold_is_applied_to_exact_similarity(self):
+        original = 'A lantern gutters in a draft from nowhere'
+        for text in ('A lantern gutters in a cold draft from nowhere',
+                     'A lantern gutters in a draft from the cellar stairs',
+                     'A candle sputters near an open window'):
+            similarity = jaccard(original, text)
+            match = self.index.find(text)
+            if similarity >= 0.6:
+                self.assertIsNotNone(match, text)
+                self.assertAlmostEqual(match['similarity'], round(similarity, 3))
+            else:
+                self.assertIsNone(match, text)
+
+    def test_remove_source(self):
+        self.index.remove_source('aspects/haunted.json')
+        self.assertIsNone(self.index.find('A lantern gutters in a draft from nowhere'))
+        self.assertEqual(self.index.stats()['buckets'], 0)
+
+    def test_limit_evicts_oldest_entries_of_the_source(self):
+        generated = ['Bones stacked neatly beside the well', 'Salt lines broken at every threshold',
+                     'A choir hums beneath the floorboards', 'Portraits turned to face the wall',
+                     'Wet footprints that end mid-corridor']
+        for text in generated:
+            self.index.add(text, 'generated', limit=3)
+        self.assertEqual(len(self.index._by_source['generated']), 3)
+        self.assertIsNone(self.index.find(generated[0]))
+        self.assertIsNone(self.index.find(generated[1]))
+        self.assertIsNotNone(self.index.find(generated[4]))
+        self.assertIsNotNone(self.index.find('A lantern gutters in a draft from nowhere'))
+
+    def test_find_can_exclude_sources(self):
+        self.assertIsNone(self.index.find('A lantern gutters in a draft from nowhere', ('aspects/haunted.json',)))
+
+
+class EntryFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.corpus = server.NearDuplicateIndex(threshold=0.6)
+        self.corpus.add('A lantern gutters in a draft from nowhere', 'aspects/haunted.json')
+        self.filter = server.EntryFilter(['Frost climbs the inside of the windows'], corpus=self.corpus)
+
+    def test_drops_corpus_avoid_list_and_repeats(self):
+        self.assertFalse(self.filter.accept('The lantern gutters in a draft from nowhere'))
+        self.assertFalse(self.filter.accept('Frost climbs the inside of the window'))
+        self.assertTrue(self.filter.accept('Bones stacked neatly beside the well'))
+        self.assertFalse(self.filter.accept('bones stacked neatly beside the well'))
+        self.assertEqual([dup['source'] for dup in self.filter.near_duplicates], ['aspects/haunted.json', 'avoid'])
+        self.assertEqual(self.filter.avoid_list()[0], 'A lantern gutters in a draft from nowhere')
+
+    def test_accepted_entries_are_indexed_as_generated(self):
+        self.assertTrue(self.filter.accept('Bones stacked neatly beside the well'))
+        match = self.corpus.find('Bones stacked neatly beside the well')
+        self.assertEqual(match['source'], server.EntryFilter.GENERATED_SOURCE)
+        # A later request sees them as taken
+        self.assertFalse(server.EntryFilter(corpus=self.corpus).accept('Bones stacked neatly beside the well'))
+
+    def test_replays_skip_and_do_not_add_generated_entries(self):
+        self.assertTrue(self.filter.accept('Bones stacked neatly beside the well'))
+        replay = server.EntryFilter(corpus=self.corpus)
+        self.assertTrue(replay.accept('Bones stacked neatly beside the well', replay=True))
+        self.assertTrue(replay.accept('Salt lines broken at every threshold', replay=True))
+        self.assertIsNone(self.corpus.find('Salt lines broken at every threshold'))
+        # Replays are still checked against the real corpus
+        self.assertFalse(replay.accept('A lantern gutters in a draft from nowhere', replay=True))
+
+
+class JSONArrayStreamParserTest(unittest.TestCase):
+    def feed_in_pieces(self, text, size):
+        parser = server.JSONArrayStreamParser()
+        entries = []
+        for i in range(0, len(text), size):
+            entries.extend(parser.feed(text[i:i + size]))
+        return parser, entries
+
+    def test_entries_arrive_across_chunk_boundaries(self):
+        values = ['Plain entry', 'Has "quotes" inside', 'Has [brackets] and {braces}', 'Ends with \\']
+        text = '```json\n' + json.dumps(values) + '\n```'
+        for size in (1, 3, 7, len(text)):
+            parser, entries = self.feed_in_pieces(text, size)
+            self.assertEqual(entries, values, size)
+            self.assertTrue(parser.finished)
+
+    def test_skips_non_string_elements_and_stops_at_closing_bracket(self):
+        parser, entries = self.feed_in_pieces('Sure: ["one", {"a": ["x"]}, 2, "two"] trailing ["three"]', 4)
+        self.assertEqual(entries, ['one', 'two'])
+
+    def test_truncated_array_keeps_completed_entries(self):
+        parser, entries = self.feed_in_pieces('["one", "two", "thr', 5)
+        self.assertEqual(entries, ['one', 'two'])
+        self.assertFalse(parser.finished)
+
+
+class ParseBatchResponseTest(unittest.TestCase):
+    def parse(self, content, finish_reason='stop', num_entries=3):
+        response = {'choices': [{'message': {'content': content}, 'finish_reason': finish_reason}]}
+        return server.parse_batch_response(response, num_entries)
+
+    def test_parse_paths(self):
+        entries = ['One entry', 'Two entry', 'Three entry']
+        self.assertEqual(self.parse(json.dumps(entries))['results'], entries)
+        self.assertEqual(self.parse('```json\n' + json.dumps(entries) + '\n```')['results'], entries)
+        self.assertEqual(self.parse('Here are your entries:\n' + json.dumps(entries))['results'], entries)
+        self.assertEqual(self.parse('- One entry\n- Two entry')['results'], ['One entry', 'Two entry'])
+        self.assertEqual(self.parse(json.dumps(entries)[:-8], finish_reason='length')['results'], entries[:2])
+
+    def test_extra_entries_are_truncated_and_errors_reported(self):
+        self.assertEqual(len(self.parse(json.dumps(['a', 'b', 'c', 'd']), num_entries=2)['results']), 2)
+        self.assertIn('error', server.parse_batch_response({'error': {'message': 'bad key'}}, 3, 401))
+        self.assertIn('error', self.parse('', finish_reason='length'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('ANVIL_LOG_LEVEL', 'error')
+os.environ.setdefault('ANVIL_CACHE_DIR', tempfile.mkdtemp(prefix='anvil-tests-'))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import standalone_server as server  # noqa: E402
+
+
+def tables():
+    return [
+        {'name': 'Banes', 'tableData': [{'floor': 1, 'ceiling': 50, 'result': 'Old bane'},
+                                        {'floor': 51, 'ceiling': 100, 'result': 'Roll twice'}]},
+        {'name': 'Boons', 'tableData': [{'floor': 1, 'ceiling': 100, 'result': 'Old boon'}]},
+    ]
+
+
+class ApplyJSONPatchTest(unittest.TestCase):
+    def test_operations(self):
+        doc = {'a': {'b': [1, 2]}, 'c/d': 'slash', 'e~f': 'tilde'}
+        patched = server.apply_json_patch(doc, [
+            {'op': 'add', 'path': '/a/b/-', 'value': 3},
+            {'op': 'add', 'path': '/a/b/0', 'value': 0},
+            {'op': 'replace', 'path': '/c~1d', 'value': 'replaced'},
+            {'op': 'remove', 'path': '/e~0f'},
+            {'op': 'copy', 'from': '/a/b', 'path': '/copied'},
+            {'op': 'move', 'from': '/copied', 'path': '/moved'},
+            {'op': 'test', 'path': '/moved/3', 'value': 3},
+        ])
+        self.assertEqual(patched, {'a': {'b': [0, 1, 2, 3]}, 'c/d': 'replaced', 'moved': [0, 1, 2, 3]})
+        # The input is never modified
+        self.assertEqual(doc, {'a': {'b': [1, 2]}, 'c/d': 'slash', 'e~f': 'tilde'})
+
+    def test_failures_are_all_or_nothing(self):
+        doc = {'a': [1]}
+        bad_patches = [
+            [{'op': 'replace', 'path': '/a/0', 'value': 2}, {'op': 'test', 'path': '/a/0', 'value': 1}],
+            [{'op': 'replace', 'path': '/missing', 'value': 1}],
+            [{'op': 'remove', 'path': '/a/5'}],
+            [{'op': 'add', 'path': '/a/9', 'value': 1}],
+            [{'op': 'add', 'path': 'no-slash', 'value': 1}],
+            [{'op': 'frobnicate', 'path': '/a'}],
+            [{'op': 'add', 'path': '/a/0'}],
+            [{'path': '/a'}],
+        ]
+        for operations in bad_patches:
+            with self.assertRaises(server.JSONPatchError, msg=operations):
+                server.apply_json_patch(doc, operations)
+        self.assertEqual(doc, {'a': [1]})
+
+    def test_replace_root(self):
+        self.assertEqual(server.apply_json_patch({'a': 1}, [{'op': 'replace', 'path': '', 'value': [1]}]), [1])
+
+
+class RowOperationsTest(unittest.TestCase):
+    def test_rows_by_table_name_or_index(self):
+        operations = server.TableFileStore.row_operations(tables(), [
+            {'table': 'banes', 'floor': 1, 'result': 'New bane'},
+            {'table': 1, 'floor': 1, 'result': 'New boon', 'ceiling': 100},
+        ])
+        self.assertEqual(operations, [
+            {'op': 'replace', 'value': 'New bane', 'path': '/0/tableData/0/result'},
+            {'op': 'replace', 'value': 'New boon', 'path': '/1/tableData/0/result'},
+            {'op': 'replace', 'value': 100, 'path': '/1/tableData/0/ceiling'},
+        ])
+
+    def test_wrapped_documents_use_the_tables_key(self):
+        operations = server.TableFileStore.row_operations({'tables': tables()},
+                                                          [{'table': 'Boons', 'floor': 1, 'result': 'x'}])
+        self.assertEqual(operations[0]['path'], '/tables/1/tableData/0/result')
+
+    def test_unknown_table_or_floor(self):
+        with self.assertRaises(server.JSONPatchError):
+            server.TableFileStore.row_operations(tables(), [{'table': 'Nope', 'floor': 1, 'result': 'x'}])
+        with self.assertRaises(server.JSONPatchError):
+            server.TableFileStore.row_operations(tables(), [{'table': 'Banes', 'floor': 7, 'result': 'x'}])
+
+
+class TableFileStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp(prefix='anvil-table-files-'))
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        (self.directory / 'aspects').mkdir()
+        self.path = self.directory / 'aspects' / 'haunted.json'
+        self.path.write_text(json.dumps(tables(), indent=2, ensure_ascii=False), encoding='utf-8')
+        self.store = server.TableFileStore(self.directory)
+
+    def test_path_validation(self):
+        self.assertEqual(self.store.path_for('aspects/haunted.json'), ('aspects/haunted', self.path))
+        for source in ('../secret', 'aspects/../../x', 'aspects/has space', ''):
+            with self.assertRaises(ValueError, msg=source):
+                self.store.path_for(source)
+
+    def test_document_validation(self):
+        self.store.validate(tables())
+        self.store.validate({'name': 'Haunted', 'tables': tables()})
+        for doc in ('just a string', {'tables': 'x'}, [{'name': 'x'}], [{'tableData': ['row']}], None):
+            with self.assertRaises(ValueError, msg=doc):
+                self.store.validate(doc)
+        with self.assertRaises(ValueError):
+            self.store.put('aspects/new', 'just a string', if_none_match='*')
+
+    def test_preconditions(self):
+        _, etag = self.store.get('aspects/haunted')
+        self.assertEqual(self.store.patch('aspects/haunted', [], None)[0], 428)
+        self.assertEqual(self.store.patch('aspects/haunted', [], '"stale"')[0], 412)
+        self.assertEqual(self.store.patch('aspects/missing', [], etag)[0], 404)
+        self.assertEqual(self.store.put('aspects/haunted', tables())[0], 428)
+        self.assertEqual(self.store.put('aspects/haunted', tables(), if_none_match='*')[0], 412)
+        self.assertEqual(self.store.put('aspects/new', tables(), if_match=etag)[0], 412)
+        self.assertEqual(self.store.put('aspects/new', tables(), if_none_match='*')[0], 201)
+
+    def test_edits_coalesce_into_one_write_in_the_original_format(self):
+        _, etag = self.store.get('aspects/haunted')
+        for i in range(3):
+            status, etag = self.store.patch('aspects/haunted', None, etag,
+                                            rows=[{'table': 'Banes', 'floor': 1, 'result': f'Edit {i}'}])
+            self.assertEqual(status, 200)
+        self.assertEqual(self.store.stats()['pending_writes'], 1)
+        self.assertEqual(self.store.flush(), 1)
+        self.assertEqual(self.store.stats()['writes'], 1)
+        self.assertEqual(self.store.stats()['coalesced_edits'], 2)
+        expected = tables()
+        expected[0]['tableData'][0]['result'] = 'Edit 2'
+        self.assertEqual(self.path.read_text(encoding='utf-8'), json.dumps(expected, indent=2, ensure_ascii=False))
+        # The chained ETag survives the write
+        self.assertEqual(self.store.get('aspects/haunted')[1], etag)
+
+    def test_external_changes_reload_unless_a_write_is_in_flight(self):
+        doc, etag = self.store.get('aspects/haunted')
+        entry = self.store._files['aspects/haunted']
+        entry['writing'] = True
+        self.path.write_text('[]', encoding='utf-8')
+        self.assertEqual(self.store.get('aspects/haunted'), (doc, etag))
+        entry['writing'] = False
+        self.assertEqual(self.store.get('aspects/haunted')[0], [])
+
+
+class HTTPHelpersTest(unittest.TestCase):
+    def test_parse_byte_range(self):
+        self.assertEqual(server.parse_byte_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(server.parse_byte_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(server.parse_byte_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(server.parse_byte_range('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(server.parse_byte_range('bytes=990-2000', 1000), (990, 999))
+        self.assertEqual(server.parse_byte_range('bytes=1000-', 1000), 'unsatisfiable')
+        self.assertEqual(server.parse_byte_range('bytes=5-1', 1000), 'unsatisfiable')
+        self.assertEqual(server.parse_byte_range('bytes=-0', 1000), 'unsatisfiable')
+        for header in (None, '', 'items=0-1', 'bytes=0-1,5-6', 'bytes=a-b'):
+            self.assertIsNone(server.parse_byte_range(header, 1000), header)
+
+    def test_etag_matches(self):
+        self.assertTrue(server.etag_matches('"abc"', '"abc"'))
+        self.assertTrue(server.etag_matches('"x", W/"abc"', '"abc"'))
+        self.assertTrue(server.etag_matches('*', '"abc"'))
+        self.assertFalse(server.etag_matches('"abd"', '"abc"'))
+        self.assertFalse(server.etag_matches(None, '"abc"'))
+
+
+if __name__ == '__main__':
+    unittest.main()